@@ -1,10 +1,25 @@
+import os
+import sys
 
-from setuptools import setup
+from setuptools import setup, Extension
 from Cython.Build import cythonize
 
+# the image kernels can split their work between threads with OpenMP (see
+# img_manip.set_num_threads). set IT8951_OPENMP=0 to build without it, e.g. if the
+# compiler doesn't support it
+if os.environ.get('IT8951_OPENMP', '1' if sys.platform.startswith('linux') else '0') == '1':
+    openmp_args = ['-fopenmp']
+else:
+    openmp_args = []
+
 setup(
     ext_modules=cythonize([
         "src/IT8951/spi.pyx",
-        "src/IT8951/img_manip.pyx"
+        Extension(
+            "IT8951.img_manip",
+            ["src/IT8951/img_manip.pyx"],
+            extra_compile_args=openmp_args,
+            extra_link_args=openmp_args
+        )
     ])
 )
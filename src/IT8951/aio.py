@@ -0,0 +1,289 @@
+'''
+This file contains asyncio counterparts of EPD and AutoEPDDisplay.
+
+Waiting for display updates to finish is done by polling the LUT engine status
+with asyncio.sleep in between, so the event loop is free in the meantime. All the
+other communication with the device (which blocks on SPI transfers and HRDY) runs
+in an executor.
+'''
+
+import asyncio
+from functools import partial
+from time import perf_counter
+
+from .constants import DisplayModes
+from .interface import EPD
+from .display import AutoEPDDisplay
+from .scheduler import UpdateScheduler
+
+
+def _in_executor(name):
+    '''
+    An async method that runs the EPD method name in the executor
+    '''
+    async def method(self, *args, **kwargs):
+        return await self._call(getattr(self.epd, name), *args, **kwargs)
+
+    method.__name__ = name
+    method.__doc__ = getattr(EPD, name).__doc__
+    return method
+
+
+class AsyncEPD:
+    '''
+    An asyncio interface to the electronic paper display.
+
+    Has the same methods as EPD, but as coroutines. Calls are made one at a time,
+    so the same AsyncEPD can safely be used from several tasks.
+
+    Parameters
+    ----------
+
+    epd : EPD, optional
+        The EPD to use. If omitted, one is created with the remaining arguments
+        (which blocks while it is being initialized)
+
+    executor : concurrent.futures.Executor, optional
+        The executor to run the blocking calls in. Defaults to the event loop's
+        default executor, which can be shared by any number of displays.
+
+    **epd_kwargs
+        Passed to EPD if epd is omitted
+    '''
+
+    def __init__(self, epd=None, executor=None, **epd_kwargs):
+        if epd is None:
+            epd = EPD(**epd_kwargs)
+
+        self.epd = epd
+        self.executor = executor
+
+        # created on first use, because before Python 3.10 an asyncio.Lock belongs to
+        # the event loop that is current when it is made, which may not be the one that
+        # ends up running (e.g. when the AsyncEPD is made before asyncio.run)
+        self._lock = None
+
+        # how long the last call to wait_display_ready took
+        self.last_display_wait = 0
+
+    @property
+    def width(self):
+        return self.epd.width
+
+    @property
+    def height(self):
+        return self.epd.height
+
+    @property
+    def spi(self):
+        return self.epd.spi
+
+    def frame_slot_address(self, slot):
+        return self.epd.frame_slot_address(slot)
+
+    async def _call(self, func, *args, **kwargs):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    load_img_area      = _in_executor('load_img_area')
+    load_img_area_1bpp = _in_executor('load_img_area_1bpp')
+    display_area       = _in_executor('display_area')
+    display_area_buf   = _in_executor('display_area_buf')
+    get_vcom           = _in_executor('get_vcom')
+    set_vcom           = _in_executor('set_vcom')
+    run                = _in_executor('run')
+    standby            = _in_executor('standby')
+    sleep              = _in_executor('sleep')
+    get_lut_status     = _in_executor('get_lut_status')
+    read_register      = _in_executor('read_register')
+    write_register     = _in_executor('write_register')
+    read_memory        = _in_executor('read_memory')
+    write_memory       = _in_executor('write_memory')
+    read_img_area      = _in_executor('read_img_area')
+
+    async def wait_display_ready(self, timeout=None):
+        '''
+        Wait until the device has finished all display updates, without blocking the
+        event loop. Returns the time waited in seconds (see EPD.wait_display_ready).
+        '''
+        start = perf_counter()
+        delay = 0.0005
+        while await self.get_lut_status():
+            if timeout is not None and perf_counter()-start > timeout:
+                raise TimeoutError("Timed out waiting for display update to finish")
+            await asyncio.sleep(delay)
+            delay = min(2*delay, 0.01)
+
+        self.last_display_wait = perf_counter()-start
+        return self.last_display_wait
+
+    async def display_area_1bpp(self, xy, dims, display_mode, zero_gray=0x00, one_gray=0xF0):
+        '''
+        Update a portion of the display from a 1bpp bitmap (see EPD.display_area_1bpp)
+        '''
+        await self._call(self.epd._enable_1bpp, zero_gray, one_gray)
+        await self.display_area(xy, dims, display_mode)
+        await self.wait_display_ready()
+        await self._call(self.epd._disable_1bpp)
+
+
+class AsyncUpdateScheduler(UpdateScheduler):
+    '''
+    An UpdateScheduler for an AsyncEPD, whose waits yield to the event loop
+    '''
+
+    async def poll(self):
+        status = await self.epd.get_lut_status()
+        self._forget_finished(status)
+        return status
+
+    async def wait_for(self, box, need_engine=False, timeout=None):
+        start = perf_counter()
+        delay = 0.0005
+        while True:
+            if self.in_flight or need_engine:
+                status = await self.poll()
+            else:
+                return 0
+
+            if self._can_start(box, need_engine, status):
+                return status
+
+            if timeout is not None and perf_counter()-start > timeout:
+                raise TimeoutError("Timed out waiting for display update to finish")
+            await asyncio.sleep(delay)
+            delay = min(2*delay, 0.01)
+
+    async def wait_all(self, timeout=None):
+        await self.epd.wait_display_ready(timeout=timeout)
+        self.in_flight.clear()
+
+    async def display_area(self, xy, dims, display_mode, address=None):
+        box = (xy[0], xy[1], xy[0]+dims[0], xy[1]+dims[1])
+
+        before = await self.wait_for(box, need_engine=True)
+        if address is None:
+            await self.epd.display_area(xy, dims, display_mode)
+        else:
+            await self.epd.display_area_buf(xy, dims, display_mode, address)
+        self._started(box, before, await self.poll())
+
+
+class AsyncAutoEPDDisplay(AutoEPDDisplay):
+    '''
+    An AutoEPDDisplay whose draw methods are coroutines:
+
+        display.frame_buf.paste(...)
+        await display.draw_partial(DisplayModes.DU)
+
+    Finding the changed regions is done in the event loop's thread; loading and
+    displaying them goes through an AsyncEPD. frame_buf shouldn't be modified while
+    a draw is in progress. Draws (and clear, resync, preload and show_slot) started
+    from several tasks are run one at a time, in the order they were started.
+
+    Parameters
+    ----------
+
+    epd : EPD or AsyncEPD, optional
+        The device to use. If omitted, an EPD is created from vcom, bus, device and
+        spi_hz (see AutoEPDDisplay)
+
+    executor : concurrent.futures.Executor, optional
+        The executor for the AsyncEPD's blocking calls, if epd is not an AsyncEPD
+
+    **kwargs
+        Passed to AutoEPDDisplay
+    '''
+
+    def __init__(self, epd=None, vcom=-2.06, bus=0, device=0, spi_hz=24000000,
+                 executor=None, **kwargs):
+
+        if epd is None:
+            epd = EPD(vcom=vcom, bus=bus, device=device, data_hz=spi_hz)
+
+        if not isinstance(epd, AsyncEPD):
+            epd = AsyncEPD(epd, executor=executor)
+
+        AutoEPDDisplay.__init__(self, epd, **kwargs)
+        self.scheduler = AsyncUpdateScheduler(self.epd)
+
+        # held for the whole of each draw, so that draws from different tasks don't
+        # interleave their updates to prev_frame. created on first use (see AsyncEPD)
+        self._draw_lock = None
+
+    def _drawing(self):
+        if self._draw_lock is None:
+            self._draw_lock = asyncio.Lock()
+        return self._draw_lock
+
+    async def draw_full(self, mode):
+        '''
+        Write the full image to the device, and display it using mode
+        '''
+        async with self._drawing():
+            await self._draw(self._full_updates(mode))
+
+    async def draw_partial(self, mode):
+        '''
+        Write only the rectangles covering the pixels of the image that have changed
+        since the last call to draw_full or draw_partial
+        '''
+        async with self._drawing():
+            await self._draw(self._partial_updates(mode))
+
+    async def _draw(self, updates):
+        # close the generator straight away if an update fails, rather than whenever it
+        # is garbage collected, so that the draw's record is dropped (see _full_updates)
+        try:
+            for args in updates:
+                await self.update_region(*args)
+        finally:
+            updates.close()
+
+    async def clear(self):
+        '''
+        Clear display, device image buffer, and frame buffer
+        '''
+        async with self._drawing():
+            self.frame_buf.paste(0xFF, box=(0, 0, self.width, self.height))
+            await self._draw(self._full_updates(DisplayModes.INIT))
+
+    async def resync(self):
+        '''
+        Rebuild prev_frame from the controller's memory (see AutoEPDDisplay.resync)
+        '''
+        async with self._drawing():
+            self._resync_from(await self.epd.read_img_area())
+
+    async def preload(self, slot, img=None):
+        '''
+        Upload img (by default, frame_buf) to a frame slot (see AutoEPDDisplay.preload)
+        '''
+        async with self._drawing():
+            await self._run_calls(self._preload_calls(slot, img))
+
+    async def show_slot(self, slot, mode):
+        '''
+        Display a preloaded frame slot (see AutoEPDDisplay.show_slot)
+        '''
+        async with self._drawing():
+            await self._run_calls(self._show_slot_calls(slot, mode))
+
+    async def update(self, data, xy, dims, mode, pixel_format=None):
+        calls = self._load_and_display_calls(data, None, xy, dims, mode, pixel_format)
+        await self._run_calls(calls)
+
+    async def update_region(self, img, box, xy, mode, pixel_format=None):
+        dims = (box[2]-box[0], box[3]-box[1])
+        await self._run_calls(self._load_and_display_calls(img, box, xy, dims, mode, pixel_format))
+
+    async def _run_calls(self, calls):
+        # the calls are to the AsyncEPD and AsyncUpdateScheduler, so they return coroutines
+        record = self._record
+        for call, lap in calls:
+            await call()
+            if lap is not None and record is not None:
+                record.lap(lap)
@@ -1,10 +1,12 @@
 
 import warnings
-from PIL import Image, ImageChops
+from functools import partial
+from PIL import Image
 
-from .constants import DisplayModes, PixelModes, low_bpp_modes
+from .constants import DisplayModes, PixelModes, Rotate, low_bpp_modes
 from .interface import EPD
-from . import img_manip
+from .scheduler import UpdateScheduler
+from . import img_manip, regions
 
 
 class AutoDisplay:
@@ -17,10 +19,45 @@ class AutoDisplay:
 
     Note: width and height should be of the physical display, and don't depend on
     rotation---they will be swapped automatically if rotate is set to CW or CCW
+
+    Partial updates are split into a small set of disjoint rectangles when the changes
+    are spread out over the display. region_overhead sets the estimated fixed cost of
+    updating one extra rectangle, in pixels (see regions.DEFAULT_OVERHEAD); setting it
+    to None always updates the single rectangle bounding all changes.
+
+    Changes are found by comparing the frames in tiles of tile_size x tile_size pixels;
+    the map of the tiles that changed in the most recent draw is available as the
+    changed_tiles attribute (see img_manip.diff_tiles).
+
+    If the areas of frame_buf that were drawn on are reported with invalidate(), the
+    next draw_partial only looks for changes inside them, rather than comparing the
+    whole frame. With diff_damage set to False, the reported areas are updated without
+    comparing them at all.
+
+    If metrics (a metrics.Metrics) is given, the time spent in each stage of every
+    draw is recorded in it.
+
+    If packed_shadow is True, prev_frame is kept packed at 4 bits per pixel (see
+    img_manip.pack_into), the format the pixels are sent to the device in, which
+    takes half the memory of an 8 bit image. Changes are then only found in the top
+    4 bits of each pixel. The width of frame_buf must be even.
     '''
 
-    def __init__(self, width, height, rotate=None, mirror=False, track_gray=False):
+    def __init__(self, width, height, rotate=None, mirror=False, track_gray=False,
+                 region_overhead=regions.DEFAULT_OVERHEAD, tile_size=32, diff_damage=True,
+                 metrics=None, packed_shadow=False):
         self._set_rotate(rotate, mirror)
+        self.region_overhead = region_overhead
+        self.tile_size = tile_size
+        self.changed_tiles = None
+
+        # the boxes passed to invalidate() since the last draw, or None if there
+        # haven't been any
+        self.diff_damage = diff_damage
+        self._damage = None
+
+        self.metrics = metrics
+        self._record = None  # the metrics.UpdateRecord of the draw in progress
 
         self.display_dims = (width, height)
         if rotate in ('CW', 'CCW'):
@@ -33,12 +70,20 @@ class AutoDisplay:
         # relevant portions of the display
         self.prev_frame = None
 
+        # the number of bits per pixel prev_frame is stored at, and the boxes (in
+        # frame_buf coordinates) of it that were already brought up to date during the
+        # draw in progress, so that they don't need to be copied again
+        self._prev_bpp = 4 if packed_shadow else 8
+        self._presynced = []
+        if packed_shadow and self.frame_buf.width % 2:
+            raise ValueError('packed_shadow requires a frame of even width')
+
         self.track_gray = track_gray
         if track_gray:
             # keep track of what has changed since the last grayscale update
             # so that we make sure we clear any black/white intermediates
             # start out with no changes
-            self.gray_change_bbox = None
+            self.gray_change_regions = []
 
     @property
     def width(self):
@@ -48,15 +93,64 @@ class AutoDisplay:
     def height(self):
         return self.frame_buf.height
 
-    def _get_frame_buf(self):
+    def _get_frame_buf(self, box=None):
         '''
-        Return the frame buf, rotated according to flip. Always returns a copy, even
-        when rotate is None.
+        Return a copy of the part of the frame buf that ends up at box on the display
+        (the whole display if box is None), rotated according to flip.
         '''
+        if box is None:
+            if self._rotate_method is None:
+                return self.frame_buf.copy()
+            return self.frame_buf.transpose(self._rotate_method)
+
+        img = self.frame_buf.crop(self._to_logical(box))
         if self._rotate_method is None:
-            return self.frame_buf.copy()
+            return img
 
-        return self.frame_buf.transpose(self._rotate_method)
+        return img.transpose(self._rotate_method)
+
+    def _to_device(self, box):
+        '''
+        Map a box in frame_buf coordinates to the coordinates passed to update(). These
+        are display coordinates, unless the rotation is left to the device itself.
+        '''
+        return regions.transpose_box(box, self._rotate_method, self.frame_buf.size)
+
+    def _to_logical(self, box):
+        '''
+        Map a box in the coordinates passed to update() to frame_buf coordinates
+        '''
+        method = regions.inverse_transpose(self._rotate_method)
+        return regions.transpose_box(box, method, self.display_dims)
+
+    def _sync_prev_frame(self, boxes=None):
+        '''
+        Copy the given boxes (in display coordinates) of frame_buf to prev_frame, or
+        all of it if boxes is None. prev_frame is only allocated once, so this doesn't
+        allocate or copy anything outside of the boxes.
+        '''
+        presynced, self._presynced = self._presynced, []
+
+        if self.prev_frame is None:
+            if self._prev_bpp == 8:
+                self.prev_frame = self.frame_buf.copy()
+                return
+            width, height = self.frame_buf.size
+            self.prev_frame = memoryview(bytearray(width*height//2)).cast('B', (height, width//2))
+            boxes = None
+
+        if boxes is None:
+            boxes = [(0, 0) + self.frame_buf.size]
+        else:
+            boxes = [self._to_logical(box) for box in boxes]
+
+        for box in boxes:
+            if box in presynced:
+                continue
+            if self._prev_bpp == 8:
+                img_manip.copy_region(self.frame_buf, self.prev_frame, box)
+            else:
+                img_manip.pack_into(self.frame_buf, self.prev_frame, 4, box)
 
     def _set_rotate(self, rotate, mirror):
 
@@ -80,64 +174,218 @@ class AutoDisplay:
 
         self._rotate_method = methods[rotate]
 
+    def invalidate(self, box=None):
+        '''
+        Report that the area box (minx, miny, maxx, maxy) of frame_buf has been drawn
+        on, or all of it if box is None. The next draw_partial then only updates the
+        areas reported since the last draw.
+
+        Changes outside of them are not lost: since prev_frame isn't updated there,
+        they are found by the next draw_partial that compares the whole frame.
+        '''
+        if box is None:
+            box = (0, 0, self.width, self.height)
+
+        if self._damage is None:
+            self._damage = []
+        self._damage.append(tuple(box))
+
     def draw_full(self, mode):
         '''
         Write the full image to the device, and display it using mode
         '''
-        frame = self._get_frame_buf()
+        for args in self._full_updates(mode):
+            self.update_region(*args)
 
-        self.update(frame.tobytes(), (0,0), self.display_dims, mode)
-
-        if self.track_gray:
-            if mode == DisplayModes.DU:
-                diff_box = self._compute_diff_box(self.prev_frame, frame, round_to=8)
-                self.gray_change_bbox = self._merge_bbox(self.gray_change_bbox, diff_box)
+    def _full_updates(self, mode):
+        '''
+        Generate the arguments of the update_region calls that draw_full makes.
+        prev_frame is brought up to date when the generator finishes.
+        '''
+        record = self._start_record('full', mode)
+
+        # only boxes packed into prev_frame during this draw count as synced already,
+        # not ones left over from a draw that didn't finish or an update outside of one
+        self._presynced = []
+
+        try:
+            self._damage = None
+
+            full_box = self._to_device((0, 0, self.width, self.height))
+            if record is not None:
+                record.regions.append(full_box)
+
+            # this has to be done before the update, which may bring prev_frame up to date
+            if self.track_gray:
+                if mode == DisplayModes.DU:
+                    if self.prev_frame is None:
+                        diff_regions = [full_box]
+                    else:
+                        diff_regions = self._compute_diff_regions(self.prev_frame, self.frame_buf,
+                                                                  round_to=8, prev_bpp=self._prev_bpp)
+                    self.gray_change_regions = self._coalesce(
+                        self.gray_change_regions + diff_regions,
+                        round_to=8
+                    )
+                else:
+                    self.gray_change_regions = []
+
+            if self._rotate_method is None:
+                yield (self.frame_buf, full_box, (0, 0), mode)
             else:
-                self.gray_change_bbox = None
+                frame = self._get_frame_buf()
+                if record is not None:
+                    record.lap('transpose')
+                yield (frame, full_box, (0, 0), mode)
+
+            if record is not None:
+                record.lap('update')
+
+            self._sync_prev_frame()
 
-        self.prev_frame = frame
+            if record is not None:
+                record.lap('sync')
+                self._finish_record(record)
+        finally:
+            # a draw that stopped part way (because an update raised, or the generator
+            # was closed) still has to put back what _start_record changed
+            if record is not None and self._record is record:
+                self._abort_record(record)
 
     def draw_partial(self, mode):
         '''
-        Write only the rectangle bounding the pixels of the image that have changed
+        Write only the rectangles covering the pixels of the image that have changed
         since the last call to draw_full or draw_partial
         '''
+        for args in self._partial_updates(mode):
+            self.update_region(*args)
 
+    def _partial_updates(self, mode):
+        '''
+        Generate the arguments of the update_region calls that draw_partial makes.
+        prev_frame is brought up to date when the generator finishes.
+        '''
         if self.prev_frame is None:  # first call since initialization
-            self.draw_full(mode)
-
-        if mode in low_bpp_modes:
-            round_box = 8
-        else:
-            round_box = 4
-
-        frame = self._get_frame_buf()
-
-        # compute diff for this frame
-        diff_box = self._compute_diff_box(self.prev_frame, frame, round_to=round_box)
-
-        if self.track_gray:
-            self.gray_change_bbox = self._merge_bbox(self.gray_change_bbox, diff_box)
-            # reset grayscale changes to zero
-            if mode != DisplayModes.DU:
-                diff_box = self._round_bbox(self.gray_change_bbox, round_to=round_box)
-                self.gray_change_bbox = None
-
-        # if it is, nothing to do
-        if diff_box is not None:
-            buf = frame.crop(diff_box)
+            yield from self._full_updates(mode)
+
+        record = self._start_record('partial', mode)
+        self._presynced = []  # see _full_updates
+
+        try:
+            round_box = self._region_alignment(mode)
+
+            # compute diff for this frame, ignoring changes that won't be seen at the
+            # number of bits per pixel the update is sent at
+            bpp = self._diff_bpp(mode)
+            damage, self._damage = self._damage, None
+            if damage is None:
+                diff_regions = self._compute_diff_regions(self.prev_frame, self.frame_buf,
+                                                          round_to=round_box, bpp=bpp,
+                                                          prev_bpp=self._prev_bpp)
+            else:
+                diff_regions = self._damage_regions(damage, round_to=round_box, bpp=bpp)
+
+            if self.track_gray and mode != DisplayModes.DU:
+                # also redraw whatever was left in black and white, and reset grayscale
+                # changes to zero
+                diff_regions = self._coalesce(
+                    self.gray_change_regions + diff_regions,
+                    round_to=round_box
+                )
+                self.gray_change_regions = []
+            gray_regions = []
+
+            if record is not None:
+                record.lap('diff')
+                record.regions.extend(diff_regions)
+
+            for diff_box in diff_regions:
+                xy = (diff_box[0], diff_box[1])
+
+                # the pixels can be sent straight from the frame buffer, unless they need
+                # to be rotated or modified first
+                if self._rotate_method is None and mode != DisplayModes.DU:
+                    yield (self.frame_buf, diff_box, xy, mode)
+                    if record is not None:
+                        record.lap('update')
+                    continue
+
+                logical_box = self._to_logical(diff_box)
+                buf = self.frame_buf.crop(logical_box)
+                if record is not None:
+                    record.lap('transpose')
+
+                # if we are using a black/white only mode, any pixels that changed should be
+                # converted to black/white. the regions where that leaves pixels showing
+                # something other than their gray level are tracked, to be redrawn later
+                if mode == DisplayModes.DU:
+                    converted = img_manip.make_changes_bw(self.prev_frame, buf, logical_box, (0, 0),
+                                                          bpp=bpp, prev_bpp=self._prev_bpp)
+                    if self.track_gray and converted:
+                        gray_regions.append(diff_box)
+                    if record is not None:
+                        record.lap('bw')
+
+                if self._rotate_method is not None:
+                    buf = buf.transpose(self._rotate_method)
+                    if record is not None:
+                        record.lap('transpose')
+
+                yield (buf, (0, 0) + buf.size, xy, mode)
+                if record is not None:
+                    record.lap('update')
+
+            if gray_regions:
+                self.gray_change_regions = self._coalesce(
+                    self.gray_change_regions + gray_regions,
+                    round_to=round_box
+                )
+
+            self._sync_prev_frame(diff_regions)
+
+            if record is not None:
+                record.lap('sync')
+                self._finish_record(record)
+        finally:
+            # a draw that stopped part way (because an update raised, or the generator
+            # was closed) still has to put back what _start_record changed
+            if record is not None and self._record is record:
+                self._abort_record(record)
+
+    def _start_record(self, kind, mode):
+        '''
+        Start the metrics.UpdateRecord of a draw, if metrics are being collected
+        '''
+        if self.metrics is None:
+            return None
+        self._record = self.metrics.start(kind, mode)
+        return self._record
 
-            # if we are using a black/white only mode, any pixels that changed should be
-            # converted to black/white
-            if mode == DisplayModes.DU:
-                img_manip.make_changes_bw(frame.crop(diff_box), buf)
+    def _finish_record(self, record):
+        self._record = None
+        self.metrics.finish(record)
 
-            xy = (diff_box[0], diff_box[1])
-            dims = (diff_box[2]-diff_box[0], diff_box[3]-diff_box[1])
+    def _abort_record(self, record):
+        '''
+        Drop the record of a draw that didn't finish
+        '''
+        self._record = None
 
-            self.update(buf.tobytes(), xy, dims, mode)
+    def _region_alignment(self, mode):
+        '''
+        The multiple to align the edges of regions updated with mode to. Either an int,
+        or a tuple (round_x, round_y).
+        '''
+        if mode in low_bpp_modes:
+            return 8
+        return 4
 
-        self.prev_frame = frame
+    def _diff_bpp(self, mode):
+        '''
+        The number of bits of each pixel that draw_partial compares, when updating with
+        mode. Changes only in the lower bits are not drawn.
+        '''
+        return 8
 
     def clear(self):
         '''
@@ -165,82 +413,478 @@ class AutoDisplay:
         round_to : int
             The multiple to align the bbox to
         '''
-        box = ImageChops.difference(a, b).getbbox()
+        box = img_manip.diff_bbox(a, b)
         if box is None:
             return None
         return cls._round_bbox(box, round_to)
 
-    @staticmethod
-    def _round_bbox(box, round_to=4):
+    def _compute_diff_regions(self, a, b, round_to=2, bpp=8, prev_bpp=8):
         '''
-        Round a bounding box so the edges are divisible by round_to
+        Find a list of disjoint rectangles, with edges divisible by round_to, covering
+        all the differences between a and b in the top bpp bits of each pixel. Nearby
+        changes are combined into a single rectangle whenever one larger update is
+        estimated to be cheaper than several small ones.
+
+        a and b are in the orientation of frame_buf, but the rectangles are returned
+        in display coordinates.
+
+        Parameters
+        ----------
+
+        a : PIL.Image
+            The first image
+
+        b : PIL.Image
+            The second image
+
+        round_to : int
+            The multiple to align the rectangles to
+
+        bpp : int
+            The number of bits of each pixel to compare
+
+        prev_bpp : int
+            8, or 4 if a is packed at 4 bits per pixel (see img_manip.diff_tiles)
         '''
-        minx, miny, maxx, maxy = box
-        minx -= minx%round_to
-        maxx += round_to-1 - (maxx-1)%round_to
-        miny -= miny%round_to
-        maxy += round_to-1 - (maxy-1)%round_to
-        return (minx, miny, maxx, maxy)
+        tile_size = self.tile_size
+        self.changed_tiles = img_manip.diff_tiles(a, b, tile_size, bpp=bpp, prev_bpp=prev_bpp)
+
+        # work out the regions at the resolution of the tiles first, so that
+        # the cost of this doesn't depend on the number of pixels
+        def bbox_of(box):
+            tile_box = (
+                box[0]//tile_size,
+                box[1]//tile_size,
+                (box[2]+tile_size-1)//tile_size,
+                (box[3]+tile_size-1)//tile_size
+            )
+            found = img_manip.tile_bbox(self.changed_tiles, tile_box)
+            if found is None:
+                return None
+            return (
+                found[0]*tile_size,
+                found[1]*tile_size,
+                min(found[2]*tile_size, b.width),
+                min(found[3]*tile_size, b.height)
+            )
+
+        full_box = (0, 0, b.width, b.height)
+        if self.region_overhead is None:
+            found = [bbox_of(full_box)]
+        else:
+            found = regions.find_regions(bbox_of, full_box,
+                                         overhead=self.region_overhead,
+                                         min_size=tile_size)
+
+        # then shrink each one to exactly fit the changes inside it
+        found = [img_manip.diff_bbox(a, b, box, bpp=bpp, prev_bpp=prev_bpp)
+                 for box in found if box is not None]
+        return self._coalesce([self._to_device(box) for box in found], round_to=round_to)
+
+    def _damage_regions(self, damage, round_to=2, bpp=8):
+        '''
+        Like _compute_diff_regions, but for the boxes in damage (in frame_buf
+        coordinates) instead of the whole frame. Unless diff_damage is False, each box
+        is first shrunk to fit the changes inside it.
+        '''
+        found = []
+        for minx, miny, maxx, maxy in damage:
+            box = (max(minx, 0), max(miny, 0), min(maxx, self.width), min(maxy, self.height))
+            if box[0] >= box[2] or box[1] >= box[3]:
+                continue
+
+            if self.diff_damage:
+                box = img_manip.diff_bbox(self.prev_frame, self.frame_buf, box, bpp=bpp,
+                                          prev_bpp=self._prev_bpp)
+                if box is None:
+                    continue
+
+            found.append(box)
 
-    @staticmethod
-    def _merge_bbox(a, b):
+        # no tiles were compared
+        self.changed_tiles = None
+        return self._coalesce([self._to_device(box) for box in found], round_to=round_to)
+
+    def _coalesce(self, boxes, round_to=1):
         '''
-        Return a bounding box that contains both bboxes a and b
+        Merge boxes into a disjoint set of rectangles aligned to round_to
+        (see regions.coalesce). Edges that would be rounded past the edge of the
+        display are kept at the edge instead.
         '''
-        if a is None:
-            return b
+        if self.region_overhead is None:
+            box = None
+            for b in boxes:
+                box = self._merge_bbox(box, b)
+            boxes = [] if box is None else [self._round_bbox(box, round_to)]
+        else:
+            boxes = regions.coalesce(boxes, round_to=round_to, overhead=self.region_overhead)
 
-        if b is None:
-            return a
+        _, _, width, height = self._to_device((0, 0) + self.frame_buf.size)
+        return [(b[0], b[1], min(b[2], width), min(b[3], height)) for b in boxes]
 
-        minx = min(a[0], b[0])
-        miny = min(a[1], b[1])
-        maxx = max(a[2], b[2])
-        maxy = max(a[3], b[3])
-        return (minx, miny, maxx, maxy)
+    _round_bbox = staticmethod(regions.round_box)
+    _merge_bbox = staticmethod(regions.merge_boxes)
 
     def update(self, data, xy, dims, mode):
         raise NotImplementedError
 
+    def update_region(self, img, box, xy, mode):
+        '''
+        Display the pixels inside box of the PIL image img at position xy, using mode.
+
+        By default this copies the pixels out and passes them to update(); derived
+        classes can override it to send them straight from img instead.
+        '''
+        dims = (box[2]-box[0], box[3]-box[1])
+        self.update(img.crop(box).tobytes(), xy, dims, mode)
+
 
 class AutoEPDDisplay(AutoDisplay):
     '''
     This class initializes the EPD, and uses it to display the updates
+
+    Unless hw_rotate is False, rotation is done by the IT8951 itself as the pixels
+    are loaded into its memory, instead of by transposing the frame on the CPU. The
+    controller can't mirror images though, so with mirror=True the frame is always
+    transposed on the CPU.
+
+    If use_2bpp is True, the pixels for updates in one of the low_bpp_modes (which
+    only distinguish a few gray levels) are sent at 2 bits per pixel instead of 4,
+    halving the amount of data transferred.
+
+    If use_1bpp is True, A2 and DU updates of regions that are purely black and white
+    are sent as 1bpp bitmaps (see EPD.load_img_area_1bpp), a quarter of the data of
+    4bpp. Regions for these modes are then aligned to 32 pixels horizontally. This
+    is only possible when the frame isn't being rotated by the device.
+
+    If pipeline is True, the pixels for an update are loaded into the controller's
+    memory while the previous updates are still being displayed, as long as they
+    don't overlap an area that is still being refreshed.
+
+    If concurrent is True, updates are started while others are still running on
+    the controller's other LUT engines, as long as they don't overlap (see
+    UpdateScheduler). Otherwise each update waits for all the previous ones to finish.
+
+    frame_slots extra full-screen image buffers are made available in the controller's
+    memory (see EPD.frame_slot_address). Frames can be uploaded to them ahead of time
+    with preload, and later displayed with show_slot without transferring any pixels.
+    Only a few fit in the controller's memory; how many depends on the display size.
+
+    If quantize_diff is True, draw_partial ignores changes to pixels that don't change
+    their value at the number of bits per pixel they would be sent at (4, or 2 for the
+    low_bpp_modes if use_2bpp is set), such as anti-aliasing noise.
+
+    With packed_shadow (see AutoDisplay), regions sent at 4bpp straight from frame_buf
+    are packed into prev_frame and sent from there, so they are only packed once.
     '''
 
     def __init__(self, epd=None, vcom=-2.06,
-                 bus=0, device=0, spi_hz=24000000,
-                 **kwargs):
+                 bus=0, device=0, spi_hz=24000000, hw_rotate=True, use_2bpp=True,
+                 use_1bpp=False, pipeline=True, concurrent=True, frame_slots=0,
+                 quantize_diff=True, **kwargs):
 
-        epd = EPD(vcom=vcom, bus=bus, device=device, data_hz=spi_hz)
+        if epd is None:
+            epd = EPD(vcom=vcom, bus=bus, device=device, data_hz=spi_hz)
 
         self.epd = epd
+        self.hw_rotate = hw_rotate
+        self.use_2bpp = use_2bpp
+        self.use_1bpp = use_1bpp
+        self.pipeline = pipeline
+        self.concurrent = concurrent
+        self.quantize_diff = quantize_diff
+        self.scheduler = UpdateScheduler(self.epd)
+
+        # the images preloaded into each frame slot, and the slots that have been displayed
+        # since we last made sure that the device is idle
+        self.frame_slots = frame_slots
+        self._slots = {}
+        self._shown_slots = set()
+
         AutoDisplay.__init__(self, self.epd.width, self.epd.height, **kwargs)
 
-    def update(self, data, xy, dims, mode, pixel_format=PixelModes.M_4BPP):
+    def _set_rotate(self, rotate, mirror):
+        AutoDisplay._set_rotate(self, rotate, mirror)
+
+        # the transpose that the device does for us, if any
+        self._device_rotate_method = None
+        self.rotate_mode = Rotate.NONE
+
+        if self.hw_rotate and not mirror and rotate is not None:
+            self._device_rotate_method = self._rotate_method
+            self._rotate_method = None
+            self.rotate_mode = {
+                'CW'   : Rotate.CW,
+                'CCW'  : Rotate.CCW,
+                'flip' : Rotate.FLIP,
+            }[rotate]
+
+    def update(self, data, xy, dims, mode, pixel_format=None):
+        self._run_calls(self._load_and_display_calls(data, None, xy, dims, mode, pixel_format))
+
+    def update_region(self, img, box, xy, mode, pixel_format=None):
+        dims = (box[2]-box[0], box[3]-box[1])
+        self._run_calls(self._load_and_display_calls(img, box, xy, dims, mode, pixel_format))
+
+    def _run_calls(self, calls):
+        '''
+        Make the device calls planned by one of the _*_calls generators, recording a
+        lap after each one that names one
+        '''
+        record = self._record
+        for call, lap in calls:
+            call()
+            if lap is not None and record is not None:
+                record.lap(lap)
+
+    def _region_alignment(self, mode):
+        if self._can_use_1bpp(mode):
+            return (32, 8)
+        return AutoDisplay._region_alignment(self, mode)
+
+    def _diff_bpp(self, mode):
+        if not self.quantize_diff:
+            return 8
+        if self.use_2bpp and mode in low_bpp_modes:
+            return 2
+        return 4
+
+    def _can_use_1bpp(self, mode):
+        return (
+            self.use_1bpp and
+            mode in (DisplayModes.A2, DisplayModes.DU) and
+            self.rotate_mode == Rotate.NONE
+        )
+
+    def _choose_pixel_format(self, xy, dims, mode):
+        '''
+        Pick the densest pixel format that can represent mode, and that the area
+        xy, dims can be sent in
+        '''
+        # these modes only use a few gray levels, so use a more dense packing for them.
+        # with 8 pixels per 16-bit word, the area must start and end on a word
+        # boundary in each row (draw_partial aligns regions to 8 pixels for these modes)
+        if self.use_2bpp and mode in low_bpp_modes and xy[0] % 8 == 0 and dims[0] % 8 == 0:
+            return PixelModes.M_2BPP
+
+        return PixelModes.M_4BPP
+
+    def _wait_for_area(self, box):
+        '''
+        The call to make before loading into the area box of the controller's memory:
+        wait until no update in progress is using it (or until all of them are done,
+        if not pipelining)
+        '''
+        if self.pipeline:
+            return partial(self.scheduler.wait_for, box)
+        return self.scheduler.wait_all
+
+    def resync(self):
+        '''
+        Rebuild prev_frame from the image in the controller's memory, instead of
+        starting over with clear(). This is useful when the program restarts while the
+        controller stays powered. frame_buf is set to the same image.
+
+        This is only accurate if everything on the screen was displayed from the main
+        image buffer: 1bpp updates and frame slots leave other data in it.
+        '''
+        self._resync_from(self.epd.read_img_area())
+
+    def _resync_from(self, img):
+        method = self._rotate_method
+        if method is None:
+            method = self._device_rotate_method
+        if method is not None:
+            img = img.transpose(regions.inverse_transpose(method))
+        self.frame_buf.paste(img)
+        self._sync_prev_frame()
+
+    def preload(self, slot, img=None):
+        '''
+        Upload img (by default, the current contents of frame_buf) to the given frame
+        slot in the controller's memory, to be displayed later with show_slot. img
+        must have the same size and mode as frame_buf.
+        '''
+        self._run_calls(self._preload_calls(slot, img))
+
+    def show_slot(self, slot, mode):
+        '''
+        Display the image preloaded into the given frame slot (see preload) using mode.
+        No pixels are transferred. frame_buf is set to the image, so that following
+        partial updates are relative to it.
+        '''
+        self._run_calls(self._show_slot_calls(slot, mode))
+
+    def _preload_calls(self, slot, img):
+        '''
+        Generate the device calls for preload, as (call, lap) pairs (see _run_calls)
+        '''
+        img, frame = self._slot_frame(slot, img)
+
+        # the slot may still be being displayed from
+        if slot in self._shown_slots:
+            yield self.scheduler.wait_all, None
+            self._shown_slots.clear()
+
+        yield partial(
+            self.epd.load_img_area,
+            frame,
+            rotate_mode=self.rotate_mode,
+            xy=(0, 0),
+            dims=frame.size,
+            pixel_format=PixelModes.M_4BPP,
+            address=self.epd.frame_slot_address(slot)
+        ), None
+        self._slots[slot] = img
+
+    def _show_slot_calls(self, slot, mode):
+        '''
+        Generate the device calls for show_slot, as (call, lap) pairs (see _run_calls)
+        '''
+        xy, dims, address = self._show_slot_start(slot)
+        for _ in self._full_updates(mode):
+            if not self.concurrent:
+                yield self.scheduler.wait_all, None
+            yield partial(self.scheduler.display_area, xy, dims, mode, address=address), None
+        self._shown_slots.add(slot)
+
+    def _slot_frame(self, slot, img):
+        '''
+        Check slot and img for preload, and return a copy of img to keep, along with
+        the frame to send to the device
+        '''
+        if not 0 <= slot < self.frame_slots:
+            raise ValueError("slot must be between 0 and frame_slots-1")
 
-        # these modes only use two pixels, so use a more dense packing for them
-        # TODO: 2BPP doesn't seem to refresh correctly?
-        # if mode in low_bpp_modes:
-        #     pixel_format = PixelModes.M_2BPP
-        # else:
-        #     pixel_format = PixelModes.M_4BPP
+        if img is None:
+            img = self.frame_buf
+        elif img.size != self.frame_buf.size or img.mode != self.frame_buf.mode:
+            raise ValueError("image must have the same size and mode as frame_buf")
+
+        if self._rotate_method is None:
+            return img.copy(), img
+        return img.copy(), img.transpose(self._rotate_method)
+
+    def _show_slot_start(self, slot):
+        '''
+        Put the image preloaded into slot in frame_buf, and return the area in device
+        coordinates and address to display it from
+        '''
+        if slot not in self._slots:
+            raise ValueError("nothing has been preloaded into slot {}".format(slot))
+
+        self.frame_buf.paste(self._slots[slot])
+        box = self._device_box((0, 0), self.frame_buf.size)
+        return (box[0], box[1]), (box[2]-box[0], box[3]-box[1]), self.epd.frame_slot_address(slot)
+
+    def _packed_source(self, buf, src_box, pixel_format):
+        '''
+        If the pixels inside src_box of buf can be sent from the packed prev_frame
+        instead, bring that part of it up to date and return it (see
+        EPD.load_img_area). Otherwise return None.
+        '''
+        if (
+            self._prev_bpp != 4 or pixel_format != PixelModes.M_4BPP or
+            buf is not self.frame_buf or src_box is None or self.prev_frame is None or
+            src_box[0] % 2 or src_box[2] % 2
+        ):
+            return None
+
+        img_manip.pack_into(self.frame_buf, self.prev_frame, 4, src_box)
+        self._presynced.append(tuple(src_box))
+        return self.prev_frame
+
+    def _send_as_bitmap(self, buf, src_box, xy, dims, mode, pixel_format):
+        '''
+        Whether the area should be sent as a 1bpp bitmap
+        '''
+        return (
+            pixel_format is None and self._can_use_1bpp(mode) and
+            xy[0] % 32 == 0 and dims[0] % 32 == 0 and
+            img_manip.is_black_white(buf, src_box)
+        )
+
+    def _device_box(self, xy, dims):
+        '''
+        The box xy, dims in the device's own coordinates
+        '''
+        box = (xy[0], xy[1], xy[0]+dims[0], xy[1]+dims[1])
+        return regions.transpose_box(box, self._device_rotate_method, (self.width, self.height))
+
+    def _load_and_display_calls(self, buf, src_box, xy, dims, mode, pixel_format):
+        '''
+        Generate the device calls to load the area src_box of buf (or all of it) into
+        xy, dims and display it, as (call, lap) pairs (see _run_calls)
+        '''
+        if self._send_as_bitmap(buf, src_box, xy, dims, mode, pixel_format):
+            # the bitmap is stored 8 pixels to a byte (see EPD.load_img_area_1bpp)
+            bitmap_box = (xy[0]//8, xy[1], (xy[0]+dims[0])//8, xy[1]+dims[1])
+            yield self._wait_for_area(bitmap_box), 'lut_wait'
+            yield partial(self.epd.load_img_area_1bpp, buf, xy, dims, src_box=src_box), 'load'
+
+            # 1bpp mode is a global setting, so nothing else can be displaying when it is
+            # turned on. display_area_1bpp waits for its own update to finish
+            yield self.scheduler.wait_all, 'lut_wait'
+            yield partial(self.epd.display_area_1bpp, xy, dims, mode), 'display'
+            return
+
+        if pixel_format is None:
+            pixel_format = self._choose_pixel_format(xy, dims, mode)
+
+        box = self._device_box(xy, dims)
 
         # send image to controller
-        self.epd.wait_display_ready()
-        self.epd.load_img_area(
-            data,
+        yield self._wait_for_area(box), 'lut_wait'
+
+        # with a packed prev_frame, the pixels are packed into it and sent from there
+        packed = self._packed_source(buf, src_box, pixel_format)
+        yield partial(
+            self.epd.load_img_area,
+            buf if packed is None else packed,
+            rotate_mode=self.rotate_mode,
             xy=xy,
             dims=dims,
-            pixel_format=pixel_format
-        )
+            pixel_format=pixel_format,
+            src_box=src_box,
+            packed=packed is not None
+        ), 'load'
 
         # display sent image
-        self.epd.display_area(
-            xy,
-            dims,
+        if not self.concurrent:
+            yield self.scheduler.wait_all, 'lut_wait'
+
+        yield partial(
+            self.scheduler.display_area,
+            (box[0], box[1]),
+            (box[2]-box[0], box[3]-box[1]),
             mode
-        )
+        ), 'display'
+
+    def _start_record(self, kind, mode):
+        record = AutoDisplay._start_record(self, kind, mode)
+        spi = getattr(self.epd, 'spi', None)
+        if record is not None and spi is not None:
+            # the SPI totals are only kept during the draw, so that they cost nothing
+            # once metrics is turned off
+            self._spi_collect_stats = spi.collect_stats
+            spi.collect_stats = True
+            self._spi_stats = spi.get_stats()
+        return record
+
+    def _finish_record(self, record):
+        spi = getattr(self.epd, 'spi', None)
+        if spi is not None:
+            stats = spi.get_stats()
+            for name, value in stats.items():
+                record.counters['spi_'+name] = value - self._spi_stats[name]
+            spi.collect_stats = self._spi_collect_stats
+        AutoDisplay._finish_record(self, record)
+
+    def _abort_record(self, record):
+        spi = getattr(self.epd, 'spi', None)
+        if spi is not None:
+            spi.collect_stats = self._spi_collect_stats
+        AutoDisplay._abort_record(self, record)
 
 
 class VirtualEPDDisplay(AutoDisplay):
@@ -258,7 +902,7 @@ class VirtualEPDDisplay(AutoDisplay):
         self.root = tk.Tk()
         self.photoimage = ImageTk.PhotoImage
 
-        self.pil_img = self._get_frame_buf().copy()
+        self.pil_img = self._get_frame_buf()
         self.tk_img = self.photoimage(self.pil_img)
         self.panel = tk.Label(self.root, image=self.tk_img)
         self.panel.pack(side="bottom", fill="both", expand="yes")
@@ -267,7 +911,7 @@ class VirtualEPDDisplay(AutoDisplay):
         self.root.destroy()
 
     def update(self, data, xy, dims, mode):
-        data_img = Image.frombytes(self._get_frame_buf().mode, dims, bytes(data))
+        data_img = Image.frombytes(self.frame_buf.mode, dims, bytes(data))
         self.pil_img.paste(data_img, box=xy)
         self.tk_img = self.photoimage(self.pil_img)
         self.panel.configure(image=self.tk_img) # not sure if this is actually necessary
@@ -6,30 +6,752 @@ This file contains functions for efficiently manipulating image data, in ways th
 aren't directly achievable in Python with Pillow.
 '''
 
+import os
+
 cimport cython
+from cython.parallel cimport prange, threadid
+from cpython.pycapsule cimport PyCapsule_GetPointer
+from libc.string cimport memcmp, memcpy
 
-@cython.boundscheck(False)
-def make_changes_bw(prev_frame, new_frame):
+cdef extern from *:
+    '''
+    #ifdef _OPENMP
+    #define IT8951_OPENMP 1
+    #else
+    #define IT8951_OPENMP 0
+    #endif
+    '''
+    const int IT8951_OPENMP
+
+# whether the module was built with OpenMP, without which the kernels always run on
+# a single thread
+PARALLEL = bool(IT8951_OPENMP)
+
+# the number of threads the kernels split images between, and the fewest pixels
+# worth handing to each of them
+cdef int _num_threads = 1
+cdef long _MIN_PIXELS_PER_THREAD = 1 << 16
+
+def set_num_threads(int n):
+    '''
+    Set the number of threads that diff_tiles, diff_bbox, make_changes_bw, pack_into
+    and pack_pixels split each image between, as horizontal bands (1 by default, 0 for
+    one per CPU). Every thread gets at least 64k pixels, so small areas are still done
+    on one. This has no effect unless the module was built with OpenMP (see PARALLEL).
+    '''
+    global _num_threads
+    if n < 0:
+        raise ValueError('number of threads must not be negative')
+    _num_threads = n if n else (os.cpu_count() or 1)
+
+def get_num_threads():
+    '''
+    The number of threads set by set_num_threads
+    '''
+    return _num_threads
+
+@cython.profile(False)
+cdef inline int _threads_for(long pixels) noexcept nogil:
+    return <int>max(1, min(<long>_num_threads, pixels // _MIN_PIXELS_PER_THREAD))
+
+cdef struct ArrowArray:
+    long long length
+    long long null_count
+    long long offset
+    long long n_buffers
+    long long n_children
+    const void** buffers
+    ArrowArray** children
+    ArrowArray* dictionary
+    void (*release)(ArrowArray*)
+    void* private_data
+
+cdef class ImageBuffer:
+    '''
+    Exposes the pixel memory of a mode "L" PIL image through the buffer protocol,
+    as a 2D (height, width) array of bytes, without copying it.
+    '''
+
+    cdef object img, capsule
+    cdef unsigned char* data
+    cdef Py_ssize_t shape[2]
+    cdef Py_ssize_t strides[2]
+
+    def __cinit__(self, img):
+        if img.mode != "L":
+            raise ValueError('image mode must be "L"')
+
+        img.load()
+        self.img = img
+        self.data = NULL
+
+        # get raw pointers to the pillow data
+        # is this hacky? ... yes. but it doesn't seem possible otherwise
+        # see: https://github.com/python-pillow/Pillow/issues/1112
+        cdef long ptr
+        cdef ArrowArray* array
+        if hasattr(img.im, 'unsafe_ptrs'):
+            ptr = dict(img.im.unsafe_ptrs)['image8']
+            self.data = (<unsigned char**>ptr)[0]
+        elif hasattr(img.im, '__arrow_c_array__'):
+            # newer versions of pillow removed unsafe_ptrs, but export the image
+            # memory (zero-copy) through the arrow C data interface instead
+            self.capsule = img.im.__arrow_c_array__()
+            array = <ArrowArray*>PyCapsule_GetPointer(self.capsule, "arrow_array")
+            self.data = <unsigned char*>array.buffers[1]
+        else:
+            raise RuntimeError('unable to access image memory with this version of pillow')
+
+        self.shape[0] = img.height
+        self.shape[1] = img.width
+        self.strides[0] = img.width
+        self.strides[1] = 1
+
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        buffer.buf = self.data
+        buffer.format = 'B'
+        buffer.internal = NULL
+        buffer.itemsize = 1
+        buffer.len = self.shape[0]*self.shape[1]
+        buffer.ndim = 2
+        buffer.obj = self
+        buffer.readonly = 0
+        buffer.shape = self.shape
+        buffer.strides = self.strides
+        buffer.suboffsets = NULL
+
+    def __releasebuffer__(self, Py_buffer *buffer):
+        pass
+
+def pixel_view(img, stride=None):
+    '''
+    Return a 2D (height, width) memoryview of the pixels of img, without copying.
+    img can be a mode "L" PIL image, or any object supporting the buffer protocol
+    (e.g. a 2D numpy array of uint8). A one-dimensional buffer is split into rows of
+    stride bytes, or treated as a single row if stride is None.
+    '''
+    if hasattr(img, 'im') and hasattr(img, 'mode'):
+        return memoryview(ImageBuffer(img))
+
+    view = memoryview(img)
+    if view.ndim == 1:
+        if stride is None:
+            stride = len(view)
+        if stride <= 0 or len(view) % stride:
+            raise ValueError('buffer length must be a multiple of the stride')
+        view = view.cast('B', (len(view)//stride, stride))
+    return view
+
+cdef inline unsigned char _bpp_mask(int bpp) except 0:
+    if bpp < 1 or bpp > 8:
+        raise ValueError('bpp must be between 1 and 8')
+    return (0xFF << (8-bpp)) & 0xFF
+
+@cython.profile(False)
+cdef bint _row_differs(const unsigned char* a, const unsigned char* b, int n,
+                       unsigned char mask) noexcept nogil:
     '''
-    Take any pixels that have changed and map them from grayscale to black/white.
+    Whether any of the first n pixels of a and b differ in the bits set in mask
     '''
+    if mask == 0xFF:
+        return memcmp(a, b, n) != 0
 
-    if prev_frame.size != new_frame.size:
+    cdef unsigned long long va, vb
+    cdef unsigned long long mask64 = mask * 0x0101010101010101ULL
+    cdef int i = 0
+    while i + 8 <= n:
+        memcpy(&va, a+i, 8)
+        memcpy(&vb, b+i, 8)
+        if (va ^ vb) & mask64:
+            return True
+        i += 8
+
+    while i < n:
+        if (a[i] ^ b[i]) & mask:
+            return True
+        i += 1
+
+    return False
+
+cdef _check_prev_dims(const unsigned char [:, :] prev, const unsigned char [:, :] new,
+                      int prev_bpp):
+    if prev_bpp == 8:
+        _check_dims(prev, new)
+    elif prev_bpp != 4:
+        raise ValueError('prev_bpp must be 8 or 4')
+    elif new.shape[1] % 2:
+        raise ValueError('packed images must have an even width')
+    elif prev.shape[0] != new.shape[0] or prev.shape[1] != new.shape[1]//2:
         raise ValueError('dimensions of images do not match')
 
-    if any(x.mode != "L" for x in (prev_frame, new_frame)):
-        raise ValueError('image mode must be "L"')
+    if prev.strides[1] != 1 or new.strides[1] != 1:
+        raise ValueError('image rows must be contiguous')
+
+@cython.profile(False)
+cdef inline const unsigned char* _prev_row(const unsigned char* row, int prev_bpp,
+                                           unsigned char* tmp, int minx, int maxx) noexcept nogil:
+    '''
+    A pointer to a row of prev_frame as 8 bit pixels. A packed 4bpp row is unpacked into
+    tmp (only between minx and maxx), with each pixel in the top 4 bits.
+    '''
+    if prev_bpp == 8:
+        return row
+
+    cdef int x
+    for x in range(minx, maxx):
+        tmp[x] = (row[x >> 1] << (4*(x & 1))) & 0xF0
+    return tmp
+
+@cython.profile(False)
+cdef void _diff_tile_row(const unsigned char* prev, Py_ssize_t prev_stride,
+                         const unsigned char* new, Py_ssize_t new_stride,
+                         int y0, int y1, int width, int tile_size, int prev_bpp,
+                         unsigned char mask, unsigned char* tmp,
+                         unsigned char* tiles) noexcept nogil:
+    '''
+    Mark the tiles that differ in one row of tiles, covering rows y0 to y1
+    '''
+    cdef const unsigned char* prev_row
+    cdef const unsigned char* new_row
+    cdef int y, tx, x0
+    cdef int cols = (width + tile_size - 1) // tile_size
+
+    for y in range(y0, y1):
+        prev_row = _prev_row(prev + y*prev_stride, prev_bpp, tmp, 0, width)
+        new_row = new + y*new_stride
+        for tx in range(cols):
+            if tiles[tx]:
+                continue
+            x0 = tx*tile_size
+            if _row_differs(prev_row+x0, new_row+x0, min(tile_size, width-x0), mask):
+                tiles[tx] = 1
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def diff_tiles(prev_frame, new_frame, int tile_size=32, int bpp=8, int prev_bpp=8):
+    '''
+    Compare two images tile by tile, and return a 2D (rows, cols) memoryview with
+    a nonzero value for each tile_size x tile_size tile that differs between them.
+    The comparison for each tile stops at the first difference found.
+
+    Only the top bpp bits of each pixel are compared, so that changes which would
+    not survive sending the pixels at bpp bits per pixel are ignored.
+
+    If prev_bpp is 4, prev_frame is a packed 4bpp image (see pack_into), which is
+    compared with the top 4 bits (at most) of new_frame.
+    '''
+    cdef const unsigned char [:, :] prev_buf = pixel_view(prev_frame)
+    cdef const unsigned char [:, :] new_buf = pixel_view(new_frame)
+    cdef unsigned char mask = _bpp_mask(min(bpp, prev_bpp))
+
+    _check_prev_dims(prev_buf, new_buf, prev_bpp)
+
+    cdef int height = new_buf.shape[0]
+    cdef int width = new_buf.shape[1]
+    cdef int rows = (height + tile_size - 1) // tile_size
+    cdef int cols = (width + tile_size - 1) // tile_size
+
+    tile_map = memoryview(bytearray(rows*cols)).cast('B', (rows, cols))
+    if rows == 0 or cols == 0:
+        return tile_map
+    cdef unsigned char [:, ::1] tiles = tile_map
+
+    # each row of tiles is compared by one thread, with its own row to unpack into
+    cdef int nthreads = _threads_for(<long>width*height)
+    cdef int tmp_width = width if prev_bpp != 8 else 0
+    cdef unsigned char [::1] tmp = bytearray(max(1, tmp_width*nthreads))
+
+    cdef int ty
+    with nogil:
+        for ty in prange(rows, num_threads=nthreads, schedule='static'):
+            _diff_tile_row(&prev_buf[0, 0], prev_buf.strides[0], &new_buf[0, 0], new_buf.strides[0],
+                           ty*tile_size, min(height, (ty+1)*tile_size), width, tile_size,
+                           prev_bpp, mask, &tmp[threadid()*tmp_width], &tiles[ty, 0])
+
+    return tile_map
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def tile_bbox(tile_map, box=None):
+    '''
+    Return the bounding box (in units of tiles) of the nonzero tiles in tile_map
+    that lie inside box (also in units of tiles), or None if there are none.
+    '''
+    cdef const unsigned char [:, :] tiles = tile_map
+
+    cdef int minx, miny, maxx, maxy
+    if box is None:
+        minx, miny, maxx, maxy = 0, 0, tiles.shape[1], tiles.shape[0]
+    else:
+        minx, miny, maxx, maxy = box
+
+    cdef int x, y
+    cdef int bminx = maxx, bminy = maxy, bmaxx = minx, bmaxy = miny
+    with nogil:
+        for y in range(miny, maxy):
+            for x in range(minx, maxx):
+                if tiles[y, x]:
+                    bminx = min(bminx, x)
+                    bmaxx = max(bmaxx, x+1)
+                    bminy = min(bminy, y)
+                    bmaxy = y+1
+
+    if bmaxy <= bminy:
+        return None
+    return (bminx, bminy, bmaxx, bmaxy)
+
+@cython.profile(False)
+cdef void _band_bbox(const unsigned char* prev, Py_ssize_t prev_stride,
+                     const unsigned char* new, Py_ssize_t new_stride,
+                     int minx, int miny, int maxx, int maxy, int prev_bpp,
+                     unsigned char mask, unsigned char* tmp, int* out) noexcept nogil:
+    '''
+    Write the bounding box of the differences inside the box to out. It is empty
+    (out[3] <= out[1]) if there are none.
+    '''
+    cdef const unsigned char* prev_row
+    cdef const unsigned char* new_row
+
+    cdef int x, y
+    cdef int bminx = maxx, bminy = maxy, bmaxx = minx, bmaxy = miny
+    for y in range(miny, maxy):
+        prev_row = _prev_row(prev + y*prev_stride, prev_bpp, tmp, minx, maxx)
+        new_row = new + y*new_stride
+        if not _row_differs(prev_row+minx, new_row+minx, maxx-minx, mask):
+            continue
+
+        bminy = min(bminy, y)
+        bmaxy = y+1
+
+        # only need to search outside what we've already found
+        for x in range(minx, bminx):
+            if (prev_row[x] ^ new_row[x]) & mask:
+                bminx = x
+                break
+
+        for x in range(maxx-1, bmaxx-1, -1):
+            if (prev_row[x] ^ new_row[x]) & mask:
+                bmaxx = x+1
+                break
+
+    out[0] = bminx
+    out[1] = bminy
+    out[2] = bmaxx
+    out[3] = bmaxy
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def diff_bbox(prev_frame, new_frame, box=None, int bpp=8, int prev_bpp=8):
+    '''
+    Return the bounding box of the pixels that differ between the two images,
+    looking only inside box (the whole image if box is None). Returns None if there
+    are no differences. Only the top bpp bits of each pixel are compared, and
+    prev_frame can be a packed 4bpp image (see diff_tiles).
+    '''
+    cdef const unsigned char [:, :] prev_buf = pixel_view(prev_frame)
+    cdef const unsigned char [:, :] new_buf = pixel_view(new_frame)
+    cdef unsigned char mask = _bpp_mask(min(bpp, prev_bpp))
+
+    _check_prev_dims(prev_buf, new_buf, prev_bpp)
+
+    cdef int minx, miny, maxx, maxy
+    minx, miny, maxx, maxy = _clip_box(box, new_buf.shape[1], new_buf.shape[0])
+
+    if maxx <= minx or maxy <= miny:
+        return None
+
+    # split into one band of rows per thread, and merge their boxes at the end
+    cdef int nbands = _threads_for(<long>(maxx-minx)*(maxy-miny))
+    cdef int band_height = (maxy-miny + nbands-1) // nbands
+    cdef int [::1] found = memoryview(bytearray(4*sizeof(int)*nbands)).cast('i')
+    cdef int tmp_width = new_buf.shape[1] if prev_bpp != 8 else 0
+    cdef unsigned char [::1] tmp = bytearray(max(1, tmp_width*nbands))
+
+    cdef int band
+    with nogil:
+        for band in prange(nbands, num_threads=nbands, schedule='static', chunksize=1):
+            _band_bbox(&prev_buf[0, 0], prev_buf.strides[0], &new_buf[0, 0], new_buf.strides[0],
+                       minx, min(maxy, miny+band*band_height),
+                       maxx, min(maxy, miny+(band+1)*band_height),
+                       prev_bpp, mask, &tmp[threadid()*tmp_width], &found[4*band])
+
+    result = None
+    for band in range(nbands):
+        if found[4*band+3] > found[4*band+1]:
+            result = _merge_boxes(result, (found[4*band], found[4*band+1],
+                                           found[4*band+2], found[4*band+3]))
+    return result
+
+cdef tuple _merge_boxes(a, tuple b):
+    if a is None:
+        return b
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
 
-    # we only need read access to this one, so might as well do it the legit way
-    cdef const unsigned char [:] prev_buf = prev_frame.tobytes()
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def copy_region(src, dst, box=None):
+    '''
+    Copy the pixels inside box (the whole image if box is None) from src to dst,
+    which must have the same dimensions. Nothing else is copied or allocated.
+    '''
+    cdef const unsigned char [:, :] src_buf = pixel_view(src)
+    cdef unsigned char [:, :] dst_buf = pixel_view(dst)
+
+    _check_dims(src_buf, dst_buf)
+
+    cdef int minx, miny, maxx, maxy
+    minx, miny, maxx, maxy = _clip_box(box, dst_buf.shape[1], dst_buf.shape[0])
+    if maxx <= minx:
+        return
+
+    cdef int y
+    with nogil:
+        for y in range(miny, maxy):
+            memcpy(&dst_buf[y, minx], &src_buf[y, minx], maxx-minx)
+
+# lookup tables for packing: _pack_lut[b][i][p] is pixel value p, reduced to 2**b bpp,
+# and shifted into position i within its output byte (first pixel in the high bits)
+ctypedef unsigned char pack_lut_t[256]
+cdef pack_lut_t _pack_lut[4][8]
+
+cdef bint _little_endian
+
+cdef void _init_pack_luts():
+    global _little_endian
+    cdef int b, bpp, i, p
+    for b in range(4):
+        bpp = 1 << b
+        for i in range(8 // bpp):
+            for p in range(256):
+                _pack_lut[b][i][p] = (p >> (8-bpp)) << (8 - bpp*(i+1))
+
+    cdef unsigned short one = 1
+    _little_endian = (<unsigned char*>&one)[0] == 1
+
+_init_pack_luts()
+
+@cython.profile(False)
+cdef inline int _bpp_index(int bpp) noexcept nogil:
+    if bpp == 1:
+        return 0
+    elif bpp == 2:
+        return 1
+    elif bpp == 4:
+        return 2
+    return 3
+
+@cython.profile(False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _pack_row(const unsigned char* src, unsigned char* dst, long n, int bpp) noexcept nogil:
+    '''
+    Pack n pixels (a multiple of 8/bpp) from src into dst.
+    '''
+    cdef long i = 0, j
+    cdef int k, pix_per_byte = 8 // bpp
+    cdef unsigned long long v, t
+    cdef unsigned char b
+    cdef pack_lut_t* lut = _pack_lut[_bpp_index(bpp)]
+
+    if bpp == 8:
+        memcpy(dst, src, n)
+        return
+
+    # fast paths, processing 8 source pixels (one 64 bit word) at a time
+    # these rely on the byte order of the words, so are only used on little
+    # endian machines (like the Raspberry Pi)
+    if _little_endian and bpp == 4:
+        while i + 8 <= n:
+            memcpy(&v, src+i, 8)
+            v &= 0xF0F0F0F0F0F0F0F0ULL
+            # high nibble of each odd pixel into the low nibble of each even one
+            t = (v | (v >> 12)) & 0x00FF00FF00FF00FFULL
+            # then gather the even bytes together
+            t = (t | (t >> 8)) & 0x0000FFFF0000FFFFULL
+            t = (t | (t >> 16)) & 0xFFFFFFFFULL
+            dst[0] = t & 0xFF
+            dst[1] = (t >> 8) & 0xFF
+            dst[2] = (t >> 16) & 0xFF
+            dst[3] = (t >> 24) & 0xFF
+            dst += 4
+            i += 8
+
+    elif _little_endian and bpp == 2:
+        while i + 8 <= n:
+            memcpy(&v, src+i, 8)
+            v &= 0xC0C0C0C0C0C0C0C0ULL
+            t = v | (v >> 10) | (v >> 20) | (v >> 30)
+            dst[0] = t & 0xFF
+            dst[1] = (t >> 32) & 0xFF
+            dst += 2
+            i += 8
+
+    # everything else goes through the lookup tables, one output byte per step
+    while i < n:
+        b = 0
+        for k in range(pix_per_byte):
+            b |= lut[k][src[i+k]]
+        dst[0] = b
+        dst += 1
+        i += pix_per_byte
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def pack_pixels(src, unsigned char [:] out, int bpp, box=None, long start=0, stride=None):
+    '''
+    Pack the pixels of src inside box (the whole image if box is None) into out, at bpp
+    bits per pixel, with the first pixel in the most significant bits of each byte.
+    The pixels are taken row by row, starting from pixel number start, until out
+    is full or the box is finished. Pixels of box outside of src are packed as 0.
+
+    src can be anything accepted by pixel_view (stride is passed to it), so pixels
+    are read directly from e.g. a frame buffer, without copying out the region first.
+
+    Returns the number of pixels packed. A partially filled last byte is padded with 0.
+    '''
+    cdef const unsigned char [:, :] pixels = pixel_view(src, stride)
+
+    if bpp not in (1, 2, 4, 8):
+        raise ValueError('bpp must be 1, 2, 4, or 8')
+
+    cdef int minx, miny, maxx, maxy
+    if box is None:
+        minx, miny, maxx, maxy = 0, 0, pixels.shape[1], pixels.shape[0]
+    else:
+        minx, miny, maxx, maxy = box
+
+    cdef int height = pixels.shape[0]
+    cdef int width = pixels.shape[1]
+    cdef int box_width = maxx - minx
+    cdef long total = <long>box_width*(maxy-miny)
+    cdef int pix_per_byte = 8 // bpp
+
+    if box_width <= 0 or start >= total:
+        return 0
+
+    cdef long count = min(total-start, <long>out.shape[0]*pix_per_byte)
+    cdef int x = minx + start % box_width
+    cdef int y = miny + start // box_width
+    cdef long i, done, n
+    cdef int r, nrows, nthreads
+    cdef int byte_idx = 0, nbits = 0, t = 0
+    cdef unsigned char pix
+
+    # fast path: whole rows of whole bytes, all inside the source image
+    cdef bint fast = (
+        minx >= 0 and miny >= 0 and maxx <= width and maxy <= height and
+        box_width % pix_per_byte == 0 and start % pix_per_byte == 0 and
+        pixels.strides[1] == 1
+    )
+
+    with nogil:
+        if fast:
+            done = 0
+
+            # the rest of a row already started
+            if x != minx:
+                done = min(count, maxx-x)
+                _pack_row(&pixels[y, x], &out[0], done, bpp)
+                y += 1
+
+            # whole rows, which are split between threads
+            nrows = (count-done) // box_width
+            nthreads = _threads_for(<long>nrows*box_width)
+            for r in prange(nrows, num_threads=nthreads, schedule='static'):
+                _pack_row(&pixels[y+r, minx], &out[(done + <long>r*box_width) // pix_per_byte],
+                          box_width, bpp)
+            done += <long>nrows*box_width
+            y += nrows
+
+            # and the start of the last one
+            if done < count:
+                _pack_row(&pixels[y, minx], &out[done // pix_per_byte], count-done, bpp)
+
+        else:
+            for i in range(count):
+                if 0 <= x < width and 0 <= y < height:
+                    pix = pixels[y, x]
+                else:
+                    pix = 0
+
+                t = (t << bpp) | (pix >> (8-bpp))
+                nbits += bpp
+                if nbits == 8:
+                    out[byte_idx] = t
+                    byte_idx += 1
+                    t = 0
+                    nbits = 0
+
+                x += 1
+                if x == maxx:
+                    x = minx
+                    y += 1
+
+            if nbits:
+                out[byte_idx] = t << (8-nbits)
 
-    # get raw pointers to the pillow data of new_frame
-    # is this hacky? ... yes. but it doesn't seem possible otherwise
-    # see: https://github.com/python-pillow/Pillow/issues/1112
-    cdef long new_ptr = dict(new_frame.im.unsafe_ptrs)['image8']
-    cdef unsigned char* new_buf = (<unsigned char**>new_ptr)[0]
+    return count
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def pack_into(src, dst, int bpp, box=None, xy=None, stride=None):
+    '''
+    Pack the pixels inside box of src (all of it if box is None) at bpp bits per pixel
+    into dst, a packed image: a 2D (height, width*bpp/8) buffer, with the first pixel
+    of each byte in the most significant bits. The top left corner of box goes to
+    pixel xy of dst (the same position as in src by default). The x coordinates and
+    width of the box must be multiples of 8/bpp, so that rows start and end on byte
+    boundaries. src is anything accepted by pixel_view.
+    '''
+    if bpp not in (1, 2, 4, 8):
+        raise ValueError('bpp must be 1, 2, 4 or 8')
+
+    cdef const unsigned char [:, :] src_buf = pixel_view(src, stride)
+    cdef unsigned char [:, :] dst_buf = pixel_view(dst)
+    cdef int pix_per_byte = 8 // bpp
+
+    if src_buf.strides[1] != 1 or dst_buf.strides[1] != 1:
+        raise ValueError('image rows must be contiguous')
+
+    cdef int minx, miny, maxx, maxy
+    minx, miny, maxx, maxy = _clip_box(box, src_buf.shape[1], src_buf.shape[0])
+    if maxx <= minx or maxy <= miny:
+        return
+
+    cdef int dx, dy
+    dx, dy = (minx, miny) if xy is None else xy
+
+    if minx % pix_per_byte or maxx % pix_per_byte or dx % pix_per_byte:
+        raise ValueError('x coordinates must be multiples of {}'.format(pix_per_byte))
+    if dx < 0 or dy < 0 or dy+maxy-miny > dst_buf.shape[0] or \
+       (dx+maxx-minx)//pix_per_byte > dst_buf.shape[1]:
+        raise ValueError('area does not fit in dst')
+
+    cdef int nthreads = _threads_for(<long>(maxx-minx)*(maxy-miny))
+    cdef int y
+    with nogil:
+        for y in prange(maxy-miny, num_threads=nthreads, schedule='static'):
+            _pack_row(&src_buf[miny+y, minx], &dst_buf[dy+y, dx//pix_per_byte], maxx-minx, bpp)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def is_black_white(src, box=None, stride=None):
+    '''
+    Whether all pixels of src inside box (the whole image if box is None) are black or
+    white at 4bpp, i.e. are in the range 0x00-0x0F or 0xF0-0xFF. Such pixels can be sent
+    at 1bpp without changing what is displayed. src is anything accepted by pixel_view.
+    '''
+    cdef const unsigned char [:, :] pixels = pixel_view(src, stride)
+
+    cdef int minx, miny, maxx, maxy
+    minx, miny, maxx, maxy = _clip_box(box, pixels.shape[1], pixels.shape[0])
+
+    cdef int x, y
+    cdef unsigned char q
+    cdef bint rtn = True
+    with nogil:
+        for y in range(miny, maxy):
+            for x in range(minx, maxx):
+                q = pixels[y, x] >> 4
+                if q != 0 and q != 0xF:
+                    rtn = False
+                    break
+            if not rtn:
+                break
+
+    return rtn
+
+cdef tuple _clip_box(box, int width, int height):
+    if box is None:
+        return (0, 0, width, height)
+    minx, miny, maxx, maxy = box
+    return (max(minx, 0), max(miny, 0), min(maxx, width), min(maxy, height))
+
+cdef _check_dims(const unsigned char [:, :] a, const unsigned char [:, :] b):
+    if a.shape[0] != b.shape[0] or a.shape[1] != b.shape[1]:
+        raise ValueError('dimensions of images do not match')
+    if a.strides[1] != 1 or b.strides[1] != 1:
+        raise ValueError('image rows must be contiguous')
+
+@cython.profile(False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline unsigned char _prev_pixel(const unsigned char* row, int x, int prev_bpp) noexcept nogil:
+    '''
+    Pixel x of a row of a prev_frame stored at prev_bpp (8 or 4) bits per pixel
+    '''
+    if prev_bpp == 8:
+        return row[x]
+    return (row[x >> 1] << (4*(x & 1))) & 0xF0
+
+@cython.profile(False)
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef long _row_to_bw(const unsigned char* prev_row, int prev_x, unsigned char* new_row, int n,
+                     int prev_bpp, unsigned char mask) noexcept nogil:
+    '''
+    Map the n pixels of new_row that differ from prev_row (starting at prev_x) to black
+    or white, and return how many of them that changed at 4bpp
+    '''
+    cdef long count = 0
     cdef int i
-    for i in range(len(prev_buf)):
-        if prev_buf[i] != new_buf[i]:
-            new_buf[i] = 0xF0 if new_buf[i] > 0xB0 else 0x00
+    cdef unsigned char p, bw
+
+    if prev_bpp == 8 and not _row_differs(prev_row+prev_x, new_row, n, mask):
+        return 0
+
+    for i in range(n):
+        p = new_row[i]
+        if (_prev_pixel(prev_row, prev_x+i, prev_bpp) ^ p) & mask:
+            bw = 0xF0 if p > 0xB0 else 0x00
+            new_row[i] = bw
+            if (bw ^ p) & 0xF0:
+                count += 1
+    return count
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def make_changes_bw(prev_frame, new_frame, box=None, xy=None, int bpp=8, int prev_bpp=8):
+    '''
+    Take any pixels that have changed and map them from grayscale to black/white, in
+    place in new_frame.
+
+    The pixels inside box of prev_frame (all of it if box is None) are compared with
+    those of the same area of new_frame, or of the area at xy if it is given. new_frame
+    can then be just the part of a frame being updated, e.g. a crop of it. As for
+    diff_bbox, only the top bpp bits of each pixel are compared, and prev_frame can be
+    packed at 4bpp (prev_bpp=4).
+
+    Returns the number of pixels whose value at 4bpp was changed by the conversion,
+    i.e. that are left showing something other than their gray level.
+    '''
+    cdef const unsigned char [:, :] prev_buf = pixel_view(prev_frame)
+    cdef unsigned char [:, :] new_buf = pixel_view(new_frame)
+    cdef unsigned char mask = _bpp_mask(min(bpp, prev_bpp))
+
+    if prev_bpp not in (8, 4):
+        raise ValueError('prev_bpp must be 8 or 4')
+    if prev_buf.strides[1] != 1 or new_buf.strides[1] != 1:
+        raise ValueError('image rows must be contiguous')
+
+    cdef int minx, miny, maxx, maxy
+    minx, miny, maxx, maxy = _clip_box(box, prev_buf.shape[1]*8//prev_bpp, prev_buf.shape[0])
+    if maxx <= minx or maxy <= miny:
+        return 0
+
+    cdef int dx, dy
+    dx, dy = (minx, miny) if xy is None else xy
+    if dx < 0 or dy < 0 or dx+maxx-minx > new_buf.shape[1] or dy+maxy-miny > new_buf.shape[0]:
+        raise ValueError('area does not fit in new_frame')
+
+    cdef int nthreads = _threads_for(<long>(maxx-minx)*(maxy-miny))
+    cdef long count = 0
+    cdef int y
+    with nogil:
+        for y in prange(maxy-miny, num_threads=nthreads, schedule='static'):
+            count += _row_to_bw(&prev_buf[miny+y, 0], minx, &new_buf[dy+y, dx], maxx-minx,
+                                prev_bpp, mask)
+    return count
@@ -2,7 +2,9 @@
 from . import constants
 from .constants import Commands, Registers, PixelModes
 
-from time import sleep
+from time import perf_counter, sleep
+
+from PIL import Image
 
 class EPD:
     '''
@@ -17,7 +19,8 @@ class EPD:
 
     **spi_kwargs
          Extra arguments will be passed to the SPI class's initialization.
-         See spi.pyx for details.
+         See spi.pyx for details. In particular, backend can be used to talk to
+         something other than /dev/spidev, such as IT8951.sim.SimulatedIT8951.
     '''
 
     def __init__(self, vcom=-1.5, **spi_kwargs):
@@ -34,6 +37,9 @@ class EPD:
         self.lut_version      = None
         self.update_system_info()
 
+        # how long the last call to wait_display_ready took
+        self.last_display_wait = 0
+
         self._set_img_buf_base_addr(self.img_buf_address)
 
         # enable I80 packed mode
@@ -41,7 +47,8 @@ class EPD:
 
         self.set_vcom(vcom)
 
-    def load_img_area(self, buf, rotate_mode=constants.Rotate.NONE, xy=None, dims=None, pixel_format=None):
+    def load_img_area(self, buf, rotate_mode=constants.Rotate.NONE, xy=None, dims=None, pixel_format=None,
+                      src_box=None, stride=None, address=None, packed=False):
         '''
         Write the pixel data in buf (an array of bytes, 1 per pixel) to device memory.
         This function does not actually display the image (see EPD.display_area).
@@ -57,11 +64,37 @@ class EPD:
 
         xy : (int, int), optional
             The x,y coordinates of the top-left corner of the area being pasted. If omitted,
-            the image is assumed to be the whole display area.
+            the image is assumed to be the whole display area. If rotate_mode is set, xy
+            and dims are in the rotated coordinate system (the one of the image data).
 
         dims : (int, int), optional
             The dimensions of the area being pasted. If xy is omitted (or set to None), the
             dimensions are assumed to be the dimensions of the display area.
+
+        pixel_format : constants.PixelModes, optional
+            The number of bits per pixel to send the image at (default 4). Pixels are
+            sent in 16-bit words, first pixel in the most significant bits. Rows are not
+            padded, so the area's x coordinate and width should be multiples of the number
+            of pixels per word (8 for 2bpp, 4 for 4bpp, 2 for 8bpp).
+
+        src_box : (int, int, int, int), optional
+            If given, buf is a larger image (e.g. a whole frame buffer) and only the pixels
+            inside this rectangle of it are sent. They are packed directly from buf, without
+            being copied out first. See SPI.pack_and_write_pixels for the types of buf
+            that are accepted.
+
+        stride : int, optional
+            The length in bytes of each row of buf, if it is a flat buffer and src_box
+            is given.
+
+        address : int, optional
+            The address of the image buffer in device memory to load into, e.g. one of
+            the frame slots (see EPD.frame_slot_address). Defaults to the main one.
+
+        packed : bool, optional
+            If True, buf holds pixels already packed at pixel_format, such as an image
+            packed with img_manip.pack_into, and is sent as it is. src_box is still in
+            pixels, and its x coordinates must fall on byte boundaries.
         '''
 
         endian_type = constants.EndianTypes.BIG
@@ -69,11 +102,6 @@ class EPD:
         if pixel_format is None:
             pixel_format = constants.PixelModes.M_4BPP
 
-        if xy is None:
-            self._load_img_start(endian_type, pixel_format, rotate_mode)
-        else:
-            self._load_img_area_start(endian_type, pixel_format, rotate_mode, xy, dims)
-
         try:
             bpp = {
                 PixelModes.M_2BPP : 2,
@@ -83,10 +111,81 @@ class EPD:
         except KeyError:
             raise ValueError("invalid pixel format") from None
 
-        self.spi.pack_and_write_pixels(buf, bpp)
+        if packed:
+            # the packed bytes are sent just like 8bpp pixels
+            if src_box is not None:
+                src_box = (src_box[0]*bpp//8, src_box[1], src_box[2]*bpp//8, src_box[3])
+            bpp = 8
+
+        if address is not None:
+            self._set_img_buf_base_addr(address)
 
+        try:
+            if xy is None:
+                self._load_img_start(endian_type, pixel_format, rotate_mode)
+            else:
+                self._load_img_area_start(endian_type, pixel_format, rotate_mode, xy, dims)
+
+            self.spi.pack_and_write_pixels(buf, bpp, box=src_box, stride=stride)
+
+            self._load_img_end()
+
+        finally:
+            if address is not None:
+                self._set_img_buf_base_addr(self.img_buf_address)
+
+    def load_img_area_1bpp(self, buf, xy, dims, src_box=None, stride=None):
+        '''
+        Write the pixel data in buf (an array of bytes, 1 per pixel) to device memory as
+        a 1 bit per pixel bitmap, to be displayed with EPD.display_area_1bpp. Pixels
+        0x80-0xFF become 1 bits, and 0x00-0x7F become 0 bits.
+
+        The bitmap is stored packed in the image buffer, 8 pixels per byte, so it
+        overwrites the bytes of the image buffer at x/8 to (x+w)/8 in each row of the
+        area (rather than at x to x+w). The x coordinate and width of the area must
+        be multiples of 32. Rotation is not supported.
+
+        See EPD.load_img_area for a description of the parameters.
+        '''
+        if xy[0] % 32 or dims[0] % 32:
+            raise ValueError("x coordinate and width of 1bpp areas must be multiples of 32")
+
+        # the device just sees this as an 8bpp image of 1/8 the width
+        self._load_img_area_start(
+            constants.EndianTypes.BIG,
+            PixelModes.M_8BPP,
+            constants.Rotate.NONE,
+            (xy[0]//8, xy[1]),
+            (dims[0]//8, dims[1])
+        )
+        self.spi.pack_and_write_pixels(buf, 1, box=src_box, stride=stride)
         self._load_img_end()
 
+    def display_area_1bpp(self, xy, dims, display_mode, zero_gray=0x00, one_gray=0xF0):
+        '''
+        Update a portion of the display from a 1bpp bitmap previously written with
+        EPD.load_img_area_1bpp. 0 bits are displayed with gray value zero_gray, and
+        1 bits with one_gray. Waits for the update to finish, because 1bpp mode has to
+        be turned back off afterwards.
+        '''
+        self._enable_1bpp(zero_gray, one_gray)
+        self.display_area(xy, dims, display_mode)
+        self.wait_display_ready()
+        self._disable_1bpp()
+
+    def _enable_1bpp(self, zero_gray, one_gray):
+        # set display to 1bpp mode
+        old_value = self.read_register(Registers.UP1SR+2)
+        self.write_register(Registers.UP1SR+2, old_value | (1<<2))
+
+        # set color table
+        self.write_register(Registers.BGVR, (zero_gray << 8) | one_gray)
+
+    def _disable_1bpp(self):
+        # back to normal mode
+        old_value = self.read_register(Registers.UP1SR+2)
+        self.write_register(Registers.UP1SR+2, old_value & ~(1<<2))
+
     def display_area(self, xy, dims, display_mode):
         '''
         Update a portion of the display to whatever is currently stored in device memory
@@ -94,6 +193,26 @@ class EPD:
         '''
         self.spi.write_cmd(Commands.DPY_AREA, xy[0], xy[1], dims[0], dims[1], display_mode)
 
+    def display_area_buf(self, xy, dims, display_mode, display_buf_address):
+        '''
+        Like EPD.display_area, but display from the image buffer at display_buf_address
+        in device memory (e.g. a frame slot, see EPD.frame_slot_address) instead of
+        the main one. No pixels are transferred.
+        '''
+        self.spi.write_cmd(Commands.DPY_BUF_AREA, xy[0], xy[1], dims[0], dims[1], display_mode,
+                           display_buf_address & 0xFFFF, display_buf_address >> 16)
+
+    def frame_slot_address(self, slot):
+        '''
+        The address in device memory of frame slot number slot (starting from 0). Each
+        slot is a full-screen image buffer of width*height bytes, and they are placed
+        one after another following the main image buffer. The device's memory is
+        limited, so only a few of them fit; how many depends on the size of the display.
+        '''
+        if slot < 0:
+            raise ValueError("slot must be non-negative")
+        return self.img_buf_address + (slot+1)*self.width*self.height
+
     def update_system_info(self):
         '''
         Get information about the system, and store it in class attributes
@@ -140,9 +259,33 @@ class EPD:
     def sleep(self):
         self.spi.write_cmd(Commands.SLEEP)
 
-    def wait_display_ready(self):
-        while(self.read_register(Registers.LUTAFSR)):
-            sleep(0.01)
+    def wait_display_ready(self, timeout=None):
+        '''
+        Wait until the device has finished all display updates. Returns the time waited
+        in seconds, which is also stored in the last_display_wait attribute.
+
+        The LUT engine status register is polled with a delay that starts short and grows
+        up to 10 ms, so that the end of short updates is noticed quickly without keeping
+        the bus busy during long ones. If timeout (in seconds) is given, a TimeoutError
+        is raised if the updates haven't finished by then.
+        '''
+        start = perf_counter()
+        delay = 0.0005
+        while self.get_lut_status():
+            if timeout is not None and perf_counter()-start > timeout:
+                raise TimeoutError("Timed out waiting for display update to finish")
+            sleep(delay)
+            delay = min(2*delay, 0.01)
+
+        self.last_display_wait = perf_counter()-start
+        return self.last_display_wait
+
+    def get_lut_status(self):
+        '''
+        Read the status of the LUT engines, as a bitmask with a bit set for each engine
+        that is busy with a display update (constants.ALL_LUTE_BUSY if all of them are)
+        '''
+        return self.read_register(Registers.LUTAFSR)
 
     def _load_img_start(self, endian_type, pixel_format, rotate_mode):
         arg = (endian_type << 8) | (pixel_format << 4) | rotate_mode
@@ -166,8 +309,7 @@ class EPD:
         '''
         Write to a device register
         '''
-        self.spi.write_cmd(Commands.REG_WR, address)
-        self.spi.write_data((val,))
+        self.spi.write_cmd(Commands.REG_WR, address, val)
 
     def _set_img_buf_base_addr(self, address):
         word0 = address >> 16
@@ -175,56 +317,93 @@ class EPD:
         self.write_register(Registers.LISAR+2, word0)
         self.write_register(Registers.LISAR, word1)
 
-    ##########
-    # the following functions are transcribed from example code from waveshare, but have not
-    # been tested
+    def mem_burst_read_trigger(self, address, count):
+        '''
+        Set up a burst read of count 16-bit words of device memory, starting at address
+        '''
+        # these are both 32 bits, so we need to split them
+        # up into two 16 bit values
+        self.spi.write_cmd(Commands.MEM_BST_RD_T,
+                           address & 0xFFFF, address >> 16, count & 0xFFFF, count >> 16)
 
-    # def mem_burst_read_trigger(self, address, count):
-    #     # these are both 32 bits, so we need to split them
-    #     # up into two 16 bit values
+    def mem_burst_read_start(self):
+        self.spi.write_cmd(Commands.MEM_BST_RD_S)
 
-    #     addr0 = address & 0xFFFF
-    #     addr1 = address >> 16
+    def mem_burst_write(self, address, count):
+        '''
+        Set up a burst write of count 16-bit words of device memory, starting at address.
+        The data follows as normal data writes.
+        '''
+        self.spi.write_cmd(Commands.MEM_BST_WR,
+                           address & 0xFFFF, address >> 16, count & 0xFFFF, count >> 16)
 
-    #     len0 = count & 0xFFFF
-    #     len1 = count >> 16
+    def mem_burst_end(self):
+        self.spi.write_cmd(Commands.MEM_BST_END)
+
+    def read_memory(self, address, count):
+        '''
+        Read count bytes of device memory starting at address (which must be even), and
+        return them as a bytearray. The read is split into as many bursts as needed to
+        fit in the SPI transfer size.
+        '''
+        if address % 2:
+            raise ValueError("address must be even")
 
-    #     self.spi.write_cmd(Commands.MEM_BST_RD_T,
-    #                        addr0, addr1, len0, len1)
+        nwords = (count+1)//2
+        data = bytearray(2*nwords)
+        view = memoryview(data)
 
-    # def mem_burst_read_start(self):
-    #     self.spi.write_cmd(Commands.MEM_BST_RD_S)
+        max_words = (self.spi.max_block_size-4)//2
+        for start in range(0, nwords, max_words):
+            n = min(max_words, nwords-start)
+            self.mem_burst_read_trigger(address+2*start, n)
+            self.mem_burst_read_start()
+            self.spi.read_data_into(view[2*start:2*(start+n)])
+            self.mem_burst_end()
 
-    # def mem_burst_write(self, address, count):
-    #     addr0 = address & 0xFFFF
-    #     addr1 = address >> 16
+        view.release()
 
-    #     len0 = count & 0xFFFF
-    #     len1 = count >> 16
+        # words are sent most significant byte first, but are stored little endian
+        data[0::2], data[1::2] = data[1::2], data[0::2]
+        del data[count:]
+        return data
 
-    #     self.spi.write_cmd(Commands.MEM_BST_WR,
-    #                    addr0, addr1, len0, len1)
+    def write_memory(self, address, data):
+        '''
+        Write the bytes data to device memory starting at address (which must be even)
+        '''
+        if address % 2:
+            raise ValueError("address must be even")
 
-    # def mem_burst_end(self):
-    #     self.spi.write_cmd(Commands.MEM_BST_END)
+        data = bytearray(data)
+        if len(data) % 2:
+            data.append(0)
 
-    # def display_area_1bpp(self, xy, dims, display_mode, background_gray, foreground_gray):
+        # words are sent most significant byte first, but are stored little endian
+        data[0::2], data[1::2] = data[1::2], data[0::2]
 
-    #     # set display to 1bpp mode
-    #     old_value = self.read_register(Registers.UP1SR+2)
-    #     self.write_register(Registers.UP1SR+2, old_val | (1<<2))
+        self.mem_burst_write(address, len(data)//2)
+        self.spi.pack_and_write_pixels(data, 8)
+        self.mem_burst_end()
 
-    #     # set color table
-    #     self.write_register(Registers.BGVR, (background_gray << 8) | foreground_gray)
+    def read_img_area(self, box=None, address=None):
+        '''
+        Read back the pixels inside box (minx, miny, maxx, maxy) of an image buffer in
+        device memory (the main one by default), and return them as a PIL image. The
+        image is in the device's own orientation, with 8 bits per pixel as they are
+        stored; pixels that were loaded at fewer bits per pixel only have meaningful
+        upper bits.
+        '''
+        if address is None:
+            address = self.img_buf_address
 
-    #     # display image
-    #     self.display_area(xy, dims, display_mode)
-    #     self.wait_display_ready()
+        if box is None:
+            box = (0, 0, self.width, self.height)
+        minx, miny, maxx, maxy = box
 
-    #     # back to normal mode
-    #     old_value = self.read_register(Registers.UP1SR+2)
-    #     self.write_register(Registers.UP1SR+2, old_value & ~(1<<2))
+        start = address + miny*self.width
+        offset = start % 2
+        data = self.read_memory(start-offset, (maxy-miny)*self.width + offset)
 
-    # def display_area_buf(self, xy, dims, display_mode, display_buf_address):
-    #     self.spi.write_cmd(Commands.DPY_BUF_AREA, xy[0], xy[1], dims[0], dims[1], display_mode,
-    #                        display_buf_address & 0xFFFF, display_buf_address >> 16)
+        img = Image.frombytes('L', (self.width, maxy-miny), bytes(data[offset:]))
+        return img.crop((minx, 0, maxx, maxy-miny))
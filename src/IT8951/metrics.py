@@ -0,0 +1,166 @@
+'''
+This file contains classes for recording where the time goes in each display update.
+
+Instrumentation is off unless a Metrics object is passed to the display:
+
+    metrics = Metrics(callback=print)
+    display = AutoEPDDisplay(vcom=-2.06, metrics=metrics)
+    ...
+    print(metrics.summary())
+
+Each call to draw_partial or draw_full then produces an UpdateRecord. When metrics
+is None, the only cost is a check of that in a few places.
+'''
+
+from collections import deque
+from time import perf_counter
+
+
+class UpdateRecord:
+    '''
+    The measurements of one draw_full or draw_partial call.
+
+    Attributes
+    ----------
+
+    kind : str
+        'full' or 'partial'
+
+    mode : constants.DisplayModes
+        The display mode
+
+    stages : dict
+        Seconds spent in each stage of the update. The stages used are:
+
+         - diff: finding the regions that changed
+         - transpose: cropping (and rotating, if done on the CPU) the regions
+         - bw: converting changed pixels to black and white, for DU updates
+         - lut_wait: waiting for display updates in progress to finish
+         - load: sending the pixels to the controller (see also the spi_* counters)
+         - display: starting the display update (including waiting for a LUT engine
+           to be free)
+         - update: anything else done while updating a region
+         - sync: copying the updated regions to prev_frame
+
+    regions : list
+        The (minx, miny, maxx, maxy) boxes that were updated, in the coordinates
+        passed to update()
+
+    counters : dict
+        Other numbers. For an AutoEPDDisplay, these are the SPI totals for the update:
+        spi_bytes, and the seconds spent in spi_pack, spi_transfer and spi_hrdy_wait
+        (packing overlaps with transfers, so these can add up to more than load).
+
+    total : float
+        Seconds from the start to the end of the call
+    '''
+
+    __slots__ = ('kind', 'mode', 'start', 'total', 'stages', 'regions', 'counters', '_last')
+
+    def __init__(self, kind, mode):
+        self.kind = kind
+        self.mode = mode
+        self.stages = {}
+        self.regions = []
+        self.counters = {}
+        self.total = None
+        self.start = self._last = perf_counter()
+
+    def lap(self, stage):
+        '''
+        Add the time since the previous call to lap to stage
+        '''
+        now = perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0) + now - self._last
+        self._last = now
+
+    def finish(self):
+        self.total = perf_counter() - self.start
+
+    def as_dict(self):
+        return {
+            'kind': self.kind,
+            'mode': self.mode,
+            'total': self.total,
+            'stages': dict(self.stages),
+            'regions': list(self.regions),
+            'counters': dict(self.counters),
+        }
+
+
+def percentile(values, p):
+    '''
+    The p'th percentile (0-100) of the sorted list values, by the nearest-rank method
+    '''
+    if not values:
+        return None
+    k = max(0, min(len(values)-1, -(-p*len(values)//100) - 1))
+    return values[int(k)]
+
+
+class Metrics:
+    '''
+    Collects the UpdateRecords of a display.
+
+    Parameters
+    ----------
+
+    window : int
+        How many of the most recent updates to keep, for the statistics
+
+    callback : callable, optional
+        Called with each UpdateRecord when its update finishes (see also
+        add_callback), e.g. to export it to a monitoring system. Called from the
+        thread doing the update, so it should return quickly.
+    '''
+
+    def __init__(self, window=1000, callback=None):
+        self.records = deque(maxlen=window)
+        self.callbacks = []
+        if callback is not None:
+            self.callbacks.append(callback)
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def start(self, kind, mode):
+        return UpdateRecord(kind, mode)
+
+    def finish(self, record):
+        record.finish()
+        self.records.append(record)
+        for callback in self.callbacks:
+            callback(record)
+
+    def clear(self):
+        self.records.clear()
+
+    def summary(self, kind=None):
+        '''
+        Statistics over the updates in the window (only those of kind, if given). Returns
+        a dict mapping 'total', each stage and each counter to a dict of its count,
+        mean, p50, p99 and max.
+        '''
+        values = {'total': []}
+        for record in self.records:
+            if kind is not None and record.kind != kind:
+                continue
+            values['total'].append(record.total)
+            for name, value in record.stages.items():
+                values.setdefault(name, []).append(value)
+            for name, value in record.counters.items():
+                values.setdefault(name, []).append(value)
+
+        summary = {}
+        for name, vals in values.items():
+            if not vals:
+                continue
+            vals.sort()
+            summary[name] = {
+                'count': len(vals),
+                'mean': sum(vals)/len(vals),
+                'p50': percentile(vals, 50),
+                'p99': percentile(vals, 99),
+                'max': vals[-1],
+            }
+        return summary
@@ -0,0 +1,194 @@
+'''
+This file contains helpers for working with rectangular regions of the display.
+
+Regions are represented the same way as PIL bounding boxes: tuples
+(minx, miny, maxx, maxy), where the max coordinates are exclusive.
+'''
+
+from PIL.Image import Transpose
+
+# Rough cost of sending one extra region to the device, expressed in pixels.
+# Each region costs a handful of command transactions (LD_IMG_AREA, LD_IMG_END,
+# DPY_AREA, ...) with a HRDY wait each, which at the default SPI rates takes
+# about as long as transferring a 128x128 block of 4bpp pixels.
+DEFAULT_OVERHEAD = 128*128
+
+
+def round_box(box, round_to=4):
+    '''
+    Round a bounding box so the edges are divisible by round_to. round_to can also be
+    a tuple (round_x, round_y) to align the two directions differently.
+    '''
+    if isinstance(round_to, tuple):
+        round_x, round_y = round_to
+    else:
+        round_x = round_y = round_to
+
+    minx, miny, maxx, maxy = box
+    minx -= minx%round_x
+    maxx += round_x-1 - (maxx-1)%round_x
+    miny -= miny%round_y
+    maxy += round_y-1 - (maxy-1)%round_y
+    return (minx, miny, maxx, maxy)
+
+
+def merge_boxes(a, b):
+    '''
+    Return a bounding box that contains both boxes a and b. Either may be None.
+    '''
+    if a is None:
+        return b
+
+    if b is None:
+        return a
+
+    minx = min(a[0], b[0])
+    miny = min(a[1], b[1])
+    maxx = max(a[2], b[2])
+    maxy = max(a[3], b[3])
+    return (minx, miny, maxx, maxy)
+
+
+def box_area(box):
+    '''
+    The number of pixels contained in box
+    '''
+    return (box[2]-box[0])*(box[3]-box[1])
+
+
+def boxes_overlap(a, b):
+    '''
+    Whether boxes a and b share any pixels
+    '''
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+
+def transpose_box(box, method, size):
+    '''
+    Find where box ends up after applying the PIL transpose method (one of
+    PIL.Image.Transpose, or None for no change) to an image of the given size.
+    '''
+    if method is None:
+        return box
+
+    minx, miny, maxx, maxy = box
+    w, h = size
+
+    if method == Transpose.FLIP_LEFT_RIGHT:
+        return (w-maxx, miny, w-minx, maxy)
+    elif method == Transpose.FLIP_TOP_BOTTOM:
+        return (minx, h-maxy, maxx, h-miny)
+    elif method == Transpose.ROTATE_90:
+        return (miny, w-maxx, maxy, w-minx)
+    elif method == Transpose.ROTATE_180:
+        return (w-maxx, h-maxy, w-minx, h-miny)
+    elif method == Transpose.ROTATE_270:
+        return (h-maxy, minx, h-miny, maxx)
+    elif method == Transpose.TRANSPOSE:
+        return (miny, minx, maxy, maxx)
+    elif method == Transpose.TRANSVERSE:
+        return (h-maxy, w-maxx, h-miny, w-minx)
+
+    raise ValueError('invalid transpose method')
+
+
+def inverse_transpose(method):
+    '''
+    The PIL transpose method that undoes method
+    '''
+    return {
+        Transpose.ROTATE_90  : Transpose.ROTATE_270,
+        Transpose.ROTATE_270 : Transpose.ROTATE_90,
+    }.get(method, method)
+
+
+def update_cost(box, overhead=DEFAULT_OVERHEAD):
+    '''
+    The estimated cost (in units of pixels transferred) of updating box on its own
+    '''
+    return overhead + box_area(box)
+
+
+def find_regions(bbox_of, box, overhead=DEFAULT_OVERHEAD, min_size=32):
+    '''
+    Find a set of rectangles covering all the changes inside box, splitting it up
+    when doing so saves more than the cost of the extra updates.
+
+    Parameters
+    ----------
+
+    bbox_of : callable
+        A function taking a box and returning the bounding box of the changed pixels
+        inside it (or None if nothing changed)
+
+    box : tuple
+        The region to search
+
+    overhead : int
+        The fixed cost of an update, in pixels (see update_cost)
+
+    min_size : int
+        Regions are not split along edges shorter than this
+    '''
+    tight = bbox_of(box)
+    if tight is None:
+        return []
+
+    minx, miny, maxx, maxy = tight
+    w, h = maxx-minx, maxy-miny
+    if box_area(tight) <= overhead or max(w, h) < 2*min_size:
+        return [tight]
+
+    # split along the longer edge, at a multiple of min_size
+    if w >= h:
+        mid = minx + (w//2)//min_size*min_size
+        halves = [(minx, miny, mid, maxy), (mid, miny, maxx, maxy)]
+    else:
+        mid = miny + (h//2)//min_size*min_size
+        halves = [(minx, miny, maxx, mid), (minx, mid, maxx, maxy)]
+
+    # only keep splitting if the halves are significantly smaller than the whole
+    sub_boxes = [b for b in (bbox_of(half) for half in halves) if b is not None]
+    saved = box_area(tight) - sum(box_area(b) for b in sub_boxes)
+    if saved <= overhead*(len(sub_boxes)-1):
+        return [tight]
+
+    rtn = []
+    for sub_box in sub_boxes:
+        rtn += find_regions(bbox_of, sub_box, overhead, min_size)
+    return rtn
+
+
+def coalesce(boxes, round_to=1, overhead=DEFAULT_OVERHEAD):
+    '''
+    Round boxes to multiples of round_to, and merge them until they are disjoint and
+    no pair of them would be cheaper to update as a single rectangle.
+
+    Returns a list of boxes.
+    '''
+    boxes = [round_box(b, round_to) for b in boxes if b is not None]
+
+    merged = True
+    while merged:
+        merged = False
+        best = None
+        for i in range(len(boxes)):
+            for j in range(i+1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                union = merge_boxes(a, b)
+                savings = update_cost(a, overhead) + update_cost(b, overhead) - update_cost(union, overhead)
+
+                # overlapping boxes always need to be merged
+                if boxes_overlap(a, b):
+                    savings = max(savings, 0)
+
+                if savings >= 0 and (best is None or savings > best[0]):
+                    best = (savings, i, j, union)
+
+        if best is not None:
+            _, i, j, union = best
+            boxes[i] = union
+            del boxes[j]
+            merged = True
+
+    return boxes
@@ -0,0 +1,113 @@
+'''
+This file contains a class that keeps track of which areas of the display the
+IT8951's LUT engines are in the middle of updating, so that updates that don't
+interfere with each other can run at the same time.
+'''
+
+from time import perf_counter, sleep
+
+from .constants import ALL_LUTE_BUSY
+from . import regions
+
+
+class UpdateScheduler:
+    '''
+    Starts display updates on an EPD, allowing them to run concurrently on the
+    controller's LUT engines as long as they don't overlap.
+
+    Each area passed to display_area is remembered along with the LUT engine the
+    controller picked for it (found from the change in the LUT status register),
+    until that engine goes idle. An update only has to wait for the updates it
+    overlaps, and for a free engine.
+
+    Updates started on the EPD directly, without going through the scheduler, are
+    not tracked; call wait_all after them.
+
+    Parameters
+    ----------
+
+    epd : EPD
+        The device to send updates to
+    '''
+
+    def __init__(self, epd):
+        self.epd = epd
+
+        # list of (box, engine mask) for the updates that may still be running
+        self.in_flight = []
+
+    def poll(self):
+        '''
+        Read the LUT engine status, forget about the updates that have finished, and
+        return the status
+        '''
+        status = self.epd.get_lut_status()
+        self._forget_finished(status)
+        return status
+
+    def _forget_finished(self, status):
+        self.in_flight = [(box, mask) for box, mask in self.in_flight if mask & status]
+
+    def busy(self, box):
+        '''
+        Whether any update that may still be in progress overlaps box. Does not poll
+        the device.
+        '''
+        return any(regions.boxes_overlap(box, b) for b, _ in self.in_flight)
+
+    def wait_for(self, box, need_engine=False, timeout=None):
+        '''
+        Wait until no update in progress overlaps box, and if need_engine is True
+        until a LUT engine is free. Returns the last LUT engine status read.
+
+        Polls with the same growing delay as EPD.wait_display_ready. If timeout (in
+        seconds) is given, a TimeoutError is raised if it takes longer than that.
+        '''
+        start = perf_counter()
+        delay = 0.0005
+        while True:
+            if self.in_flight or need_engine:
+                status = self.poll()
+            else:
+                # nothing tracked and no engine needed, so no need to ask the device
+                return 0
+
+            if self._can_start(box, need_engine, status):
+                return status
+
+            if timeout is not None and perf_counter()-start > timeout:
+                raise TimeoutError("Timed out waiting for display update to finish")
+            sleep(delay)
+            delay = min(2*delay, 0.01)
+
+    def _can_start(self, box, need_engine, status):
+        return not self.busy(box) and not (need_engine and status == ALL_LUTE_BUSY)
+
+    def wait_all(self, timeout=None):
+        '''
+        Wait until the device has finished all display updates
+        '''
+        self.epd.wait_display_ready(timeout=timeout)
+        self.in_flight.clear()
+
+    def display_area(self, xy, dims, display_mode, address=None):
+        '''
+        Start updating the area xy, dims of the display (in device coordinates),
+        once the updates that it overlaps have finished. If address is given, the
+        image is displayed from the image buffer there (see EPD.display_area_buf).
+        '''
+        box = (xy[0], xy[1], xy[0]+dims[0], xy[1]+dims[1])
+
+        before = self.wait_for(box, need_engine=True)
+        if address is None:
+            self.epd.display_area(xy, dims, display_mode)
+        else:
+            self.epd.display_area_buf(xy, dims, display_mode, address)
+        self._started(box, before, self.poll())
+
+    def _started(self, box, before, after):
+        # the engine that turned on is running our update. if that can't be told (because
+        # an engine finished and was picked again in the meantime), assume any of them is
+        engines = (after & ~before) or after
+        if engines:
+            self.in_flight.append((box, engines))
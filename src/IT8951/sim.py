@@ -0,0 +1,473 @@
+'''
+This file contains a software model of the IT8951 controller, which can be used as
+the backend of the SPI class to run (and time) the library's code without a device:
+
+    from IT8951.interface import EPD
+    from IT8951.sim import SimulatedIT8951
+
+    sim = SimulatedIT8951(dims=(800, 600))
+    epd = EPD(backend=sim)
+
+The model decodes the stream of commands and data sent over SPI, and implements the
+registers, image loading at every pixel format, memory bursts, and display commands
+that the library uses. Display updates keep a LUT engine busy for a configurable
+amount of time, and the HRDY pin can be made to go low after every transaction.
+What is displayed is available as a PIL image (the screen attribute); the effects of
+the waveforms themselves are not modelled.
+'''
+
+from threading import Lock
+from time import perf_counter, sleep
+
+from PIL import Image
+
+from .constants import Commands, Registers, Rotate, PixelModes, EndianTypes, DisplayModes
+from . import regions
+
+# rough duration in seconds of an update in each display mode
+DEFAULT_UPDATE_TIMES = {
+    DisplayModes.INIT  : 2.0,
+    DisplayModes.DU    : 0.26,
+    DisplayModes.GC16  : 0.45,
+    DisplayModes.GL16  : 0.45,
+    DisplayModes.GLR16 : 0.45,
+    DisplayModes.GLD16 : 0.45,
+    DisplayModes.A2    : 0.12,
+    DisplayModes.DU4   : 0.29,
+}
+
+# the number of argument words each command takes (setting VCOM takes one more)
+_NUM_ARGS = {
+    Commands.SYS_RUN      : 0,
+    Commands.STANDBY      : 0,
+    Commands.SLEEP        : 0,
+    Commands.REG_RD       : 1,
+    Commands.REG_WR       : 2,
+    Commands.MEM_BST_RD_T : 4,
+    Commands.MEM_BST_RD_S : 0,
+    Commands.MEM_BST_WR   : 4,
+    Commands.MEM_BST_END  : 0,
+    Commands.LD_IMG       : 1,
+    Commands.LD_IMG_AREA  : 5,
+    Commands.LD_IMG_END   : 0,
+    Commands.DPY_AREA     : 5,
+    Commands.GET_DEV_INFO : 0,
+    Commands.DPY_BUF_AREA : 7,
+    Commands.VCOM         : 1,
+}
+
+# 3bpp pixels are sent in 4 bit fields, with the lowest bit ignored
+_FIELD_BITS = {
+    PixelModes.M_2BPP : 2,
+    PixelModes.M_3BPP : 4,
+    PixelModes.M_4BPP : 4,
+    PixelModes.M_8BPP : 8,
+}
+
+_TRANSPOSES = {
+    Rotate.NONE : None,
+    Rotate.CW   : Image.Transpose.ROTATE_270,
+    Rotate.CCW  : Image.Transpose.ROTATE_90,
+    Rotate.FLIP : Image.Transpose.ROTATE_180,
+}
+
+
+def _reverse_fields_table(bits):
+    '''
+    A bytes.translate table reversing the order of the bits-wide fields in a byte
+    '''
+    table = bytearray(256)
+    for b in range(256):
+        fields = [(b >> shift) & ((1 << bits)-1) for shift in range(0, 8, bits)]
+        for f in fields:
+            table[b] = (table[b] << bits) | f
+    return bytes(table)
+
+
+class ProtocolError(Exception):
+    '''
+    Raised by SimulatedIT8951 when it is sent something a real device wouldn't accept
+    '''
+
+
+class SimulatedIT8951:
+    '''
+    A model of an IT8951 and its display, for use as an SPI backend.
+
+    Parameters
+    ----------
+
+    dims : (int, int)
+        The size of the display
+
+    img_buf_address : int
+        The address of the main image buffer, reported by GET_DEV_INFO
+
+    memory_size : int
+        Bytes of device memory
+
+    update_times : dict or float
+        The time in seconds that a display update in each mode keeps its LUT engine
+        busy (see DEFAULT_UPDATE_TIMES). A single number is used for all modes.
+
+    n_engines : int
+        The number of LUT engines. While they are all busy, a display command holds
+        HRDY low until one of them finishes.
+
+    hrdy_time : float
+        The time in seconds that HRDY goes low after each transaction. Transactions
+        started while HRDY is low raise ProtocolError.
+
+    transfer_time : bool
+        Whether transfers take as long as they would at the requested SPI clock rate
+
+    max_block_size : int
+        The largest transfer accepted, like the spidev bufsiz parameter
+    '''
+
+    def __init__(self, dims=(800, 600), img_buf_address=0x100000, memory_size=16*2**20,
+                 update_times=DEFAULT_UPDATE_TIMES, n_engines=16, hrdy_time=0.0,
+                 transfer_time=False, max_block_size=4096):
+        self.width, self.height = dims
+        self.img_buf_address = img_buf_address
+        self.memory = bytearray(memory_size)
+        self.screen = Image.new('L', dims, 0xFF)
+        self.vcom = 0
+
+        if isinstance(update_times, dict):
+            self.update_times = dict(update_times)
+        else:
+            self.update_times = {mode: update_times for mode in DEFAULT_UPDATE_TIMES}
+
+        self.n_engines = n_engines
+        self.hrdy_time = hrdy_time
+        self.transfer_time = transfer_time
+        self.max_block_size = max_block_size
+
+        # statistics, e.g. for benchmarks and tests
+        self.bytes_transferred = 0
+        self.displays = []  # (box, mode, address) of each display update
+        self.collisions = 0  # updates started on top of ones still running
+        self.max_concurrent = 0  # most updates running at once
+
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        '''
+        Reset the controller. Memory and what is displayed are kept.
+        '''
+        self.registers = {}
+        self.power = 'run'
+
+        # (end time, box) of the update each LUT engine is running
+        self._engines = [(0, None)]*self.n_engines
+        self._ready_at = 0
+
+        self._cmd = None
+        self._args = []
+        self._args_needed = 0
+        self._stream = None
+        self._stream_target = None
+        self._burst = (0, 0)
+        self._read_data = bytearray()
+
+    ##### the backend interface used by the SPI class
+
+    def transfer(self, data, speed_hz):
+        if len(data) > self.max_block_size:
+            raise ProtocolError("transfer of {} bytes is larger than the maximum of {}"
+                                .format(len(data), self.max_block_size))
+
+        with self._lock:
+            if perf_counter() < self._ready_at:
+                raise ProtocolError("transaction started while HRDY was low")
+
+            if self.transfer_time:
+                sleep(8*len(data)/speed_hz)
+
+            self.bytes_transferred += len(data)
+            rx = self._transaction(bytes(data))
+            self._ready_at = max(self._ready_at, perf_counter() + self.hrdy_time)
+            return rx
+
+    def hrdy(self):
+        return perf_counter() >= self._ready_at
+
+    def wait_hrdy(self, timeout):
+        sleep(max(0, min(timeout, self._ready_at - perf_counter())))
+
+    ##### inspecting the device
+
+    def image(self, address=None):
+        '''
+        The contents of the image buffer at address (the main one by default), as a
+        PIL image
+        '''
+        if address is None:
+            address = self.img_buf_address
+        size = self.width*self.height
+        return Image.frombytes('L', (self.width, self.height), bytes(self.memory[address:address+size]))
+
+    def lut_status(self):
+        '''
+        The value of the LUTAFSR register: a bit set for each busy LUT engine
+        '''
+        now = perf_counter()
+        return sum(1 << i for i, (end, _) in enumerate(self._engines) if end > now)
+
+    ##### decoding the SPI stream
+
+    def _transaction(self, data):
+        n = len(data)
+        if n < 2:
+            raise ProtocolError("transaction too short")
+
+        preamble = (data[0] << 8) | data[1]
+
+        if preamble == 0x6000:
+            for i in range(2, n-1, 2):
+                self._command((data[i] << 8) | data[i+1])
+
+        elif preamble == 0x0000:
+            self._data(memoryview(data)[2:])
+
+        elif preamble == 0x1000:
+            # one dummy word, then the data
+            count = n-4
+            out = self._read_data[:count]
+            del self._read_data[:count]
+            return bytes(4) + bytes(out) + bytes(count-len(out))
+
+        else:
+            raise ProtocolError("unknown preamble 0x{:04x}".format(preamble))
+
+        return bytes(n)
+
+    def _command(self, code):
+        if code not in _NUM_ARGS:
+            raise ProtocolError("unknown command 0x{:x}".format(code))
+
+        if self._args_needed:
+            raise ProtocolError("command 0x{:x} sent before the arguments of command 0x{:x}"
+                                .format(code, self._cmd))
+
+        if self._stream is not None and code not in (Commands.LD_IMG_END, Commands.MEM_BST_END):
+            raise ProtocolError("command 0x{:x} sent in the middle of a data transfer".format(code))
+
+        self._cmd = code
+        self._args = []
+        self._args_needed = _NUM_ARGS[code]
+        if not self._args_needed:
+            self._execute()
+
+    def _data(self, data):
+        i = 0
+        while self._args_needed and i+1 < len(data):
+            self._args.append((data[i] << 8) | data[i+1])
+            self._args_needed -= 1
+            i += 2
+            if not self._args_needed:
+                self._execute()
+
+        if i < len(data):
+            if self._stream is None:
+                raise ProtocolError("unexpected data")
+            self._stream += data[i:]
+
+    def _execute(self):
+        cmd, args = self._cmd, self._args
+
+        if cmd == Commands.SYS_RUN:
+            self.power = 'run'
+        elif cmd == Commands.STANDBY:
+            self.power = 'standby'
+        elif cmd == Commands.SLEEP:
+            self.power = 'sleep'
+
+        elif cmd == Commands.REG_RD:
+            self._reply([self._read_register(args[0])])
+        elif cmd == Commands.REG_WR:
+            self.registers[args[0]] = args[1]
+
+        elif cmd == Commands.MEM_BST_RD_T:
+            self._burst = (args[0] | (args[1] << 16), args[2] | (args[3] << 16))
+        elif cmd == Commands.MEM_BST_RD_S:
+            address, count = self._burst
+            data = bytearray(self.memory[address:address+2*count])
+            data[0::2], data[1::2] = data[1::2], data[0::2]
+            self._read_data += data
+        elif cmd == Commands.MEM_BST_WR:
+            self._start_stream(('memory', args[0] | (args[1] << 16), args[2] | (args[3] << 16)))
+        elif cmd == Commands.MEM_BST_END:
+            if self._stream_target is not None and self._stream_target[0] == 'memory':
+                self._end_memory_write()
+
+        elif cmd == Commands.LD_IMG:
+            self._start_stream(('image', args[0], None))
+        elif cmd == Commands.LD_IMG_AREA:
+            self._start_stream(('image', args[0], ((args[1], args[2]), (args[3], args[4]))))
+        elif cmd == Commands.LD_IMG_END:
+            if self._stream_target is None or self._stream_target[0] != 'image':
+                raise ProtocolError("LD_IMG_END without an image being loaded")
+            self._end_image_load()
+
+        elif cmd == Commands.DPY_AREA:
+            self._display(args[:4], args[4], self.img_buf_address)
+        elif cmd == Commands.DPY_BUF_AREA:
+            self._display(args[:4], args[4], args[5] | (args[6] << 16))
+
+        elif cmd == Commands.GET_DEV_INFO:
+            info = [self.width, self.height,
+                    self.img_buf_address & 0xFFFF, self.img_buf_address >> 16]
+            info += self._string_words('SWv_sim')
+            info += self._string_words('M641')
+            self._reply(info)
+
+        elif cmd == Commands.VCOM:
+            if args == [0]:
+                self._reply([self.vcom])
+            elif args == [1]:
+                # the value follows
+                self._args_needed = 1
+                return
+            else:
+                self.vcom = args[1]
+
+    def _reply(self, words):
+        for word in words:
+            self._read_data += word.to_bytes(2, 'big')
+
+    @staticmethod
+    def _string_words(s):
+        s = s.ljust(16, '\0')
+        return [(ord(s[i]) << 8) | ord(s[i+1]) for i in range(0, 16, 2)]
+
+    def _read_register(self, address):
+        if address == Registers.LUTAFSR:
+            return self.lut_status()
+        return self.registers.get(address, 0)
+
+    ##### memory and images
+
+    def _start_stream(self, target):
+        self._stream = bytearray()
+        self._stream_target = target
+
+    def _end_memory_write(self):
+        _, address, count = self._stream_target
+        data = self._stream[:2*count]
+        self._stream = self._stream_target = None
+
+        # words are sent most significant byte first, but are stored little endian
+        data[0::2], data[1::2] = data[1::2], data[0::2]
+        self.memory[address:address+len(data)] = data
+
+    def _end_image_load(self):
+        _, arg, area = self._stream_target
+        data = bytes(self._stream)
+        self._stream = self._stream_target = None
+
+        endian = arg >> 8
+        pixel_format = (arg >> 4) & 0x3
+        rotate_mode = arg & 0x3
+
+        method = _TRANSPOSES[rotate_mode]
+        if rotate_mode in (Rotate.CW, Rotate.CCW):
+            size = (self.height, self.width)
+        else:
+            size = (self.width, self.height)
+
+        if area is None:
+            xy, dims = (0, 0), size
+        else:
+            xy, dims = area
+
+        img = self._unpack(data, dims, pixel_format, endian)
+        box = (xy[0], xy[1], xy[0]+dims[0], xy[1]+dims[1])
+        if method is not None:
+            img = img.transpose(method)
+            box = regions.transpose_box(box, method, size)
+
+        if box[0] < 0 or box[1] < 0 or box[2] > self.width or box[3] > self.height:
+            raise ProtocolError("image area {} is outside of the display".format(box))
+
+        address = self.registers.get(Registers.LISAR, 0) | (self.registers.get(Registers.LISAR+2, 0) << 16)
+        self._write_rect(address, box, img.tobytes())
+
+    def _unpack(self, data, dims, pixel_format, endian):
+        bits = _FIELD_BITS[pixel_format]
+        npix = dims[0]*dims[1]
+        nbytes = (npix*bits + 7)//8
+        if len(data) < nbytes:
+            raise ProtocolError("expected {} bytes of pixel data, got {}".format(nbytes, len(data)))
+        data = bytearray(data[:nbytes + nbytes % 2])
+
+        # in little endian mode, the first pixel is in the least significant bits of
+        # each word. reorder it to be like big endian
+        if endian == EndianTypes.LITTLE:
+            data[0::2], data[1::2] = data[1::2], data[0::2]
+            if bits < 8:
+                data = data.translate(_reverse_fields_table(bits))
+
+        rawmode = 'L' if bits == 8 else 'L;{}'.format(bits)
+        img = Image.frombytes('L', dims, bytes(data), 'raw', rawmode)
+
+        if pixel_format == PixelModes.M_3BPP:
+            img = img.point(lambda p: (p >> 5)*0x24 + (p >> 7))
+        return img
+
+    def _write_rect(self, address, box, data):
+        minx, miny, maxx, maxy = box
+        w = maxx-minx
+        if address + maxy*self.width > len(self.memory):
+            raise ProtocolError("image doesn't fit in device memory")
+
+        for row in range(maxy-miny):
+            start = address + (miny+row)*self.width + minx
+            self.memory[start:start+w] = data[row*w:(row+1)*w]
+
+    def _read_rect(self, address, box):
+        minx, miny, maxx, maxy = box
+        return b''.join(
+            self.memory[address + y*self.width + minx : address + y*self.width + maxx]
+            for y in range(miny, maxy)
+        )
+
+    ##### display updates
+
+    def _display(self, area, mode, address):
+        x, y, w, h = area
+        box = (x, y, x+w, y+h)
+        if w <= 0 or h <= 0 or x+w > self.width or y+h > self.height:
+            raise ProtocolError("display area {} is outside of the display".format(box))
+
+        if mode not in self.update_times:
+            raise ProtocolError("unknown display mode {}".format(mode))
+
+        if self.registers.get(Registers.UP1SR+2, 0) & (1 << 2):
+            # 1bpp mode: the area holds a bitmap, 8 pixels to a byte
+            bitmap = self._read_rect(address, (x//8, y, (x+w)//8, y+h))
+            img = Image.frombytes('1', (w, h), bitmap).convert('L')
+            colors = self.registers.get(Registers.BGVR, 0x00FF)
+            zero_gray, one_gray = colors >> 8, colors & 0xFF
+            img = img.point(lambda p: one_gray if p else zero_gray)
+        else:
+            img = Image.frombytes('L', (w, h), self._read_rect(address, box))
+
+        self.screen.paste(img, box=box)
+        self.displays.append((box, mode, address))
+
+        # find a LUT engine for the update. if they're all busy, the device waits
+        # (with HRDY low) for the first one to finish
+        now = perf_counter()
+        engine = min(range(self.n_engines), key=lambda i: self._engines[i][0])
+        start = max(now, self._engines[engine][0])
+        self._ready_at = max(self._ready_at, start)
+
+        if any(end > start and regions.boxes_overlap(box, b) for end, b in self._engines):
+            self.collisions += 1
+
+        self._engines[engine] = (start + self.update_times[mode], box)
+        running = sum(end > start for end, _ in self._engines)
+        self.max_concurrent = max(self.max_concurrent, running)
@@ -6,6 +6,9 @@ This module implements SPI communication with the device through the Linux kerne
 using /dev/spidev*. It also implements pixel packing for the communication, and
 handles operating the RESET and HRDY pins on the device.
 
+Alternatively, the transfers and pins can be handled by a backend object, such as
+the software model of the device in IT8951.sim (see the SPI class).
+
 It incorporates ideas/code from:
 
  - py-spidev: https://github.com/doceme/py-spidev
@@ -16,12 +19,16 @@ It incorporates ideas/code from:
 cimport cython
 import os
 from posix.ioctl cimport ioctl
-from libc.string cimport memset
-from time import time, sleep
+from libc.string cimport memcpy, memset
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
 
-import RPi.GPIO as GPIO
+# RPi.GPIO is imported when it is first needed, so that this module can be used
+# with a backend on machines that don't have it
+GPIO = None
 
 from .constants import Pins, PixelModes
+from .img_manip import pack_pixels
 
 cdef extern from "linux/spi/spidev.h":
     struct spi_ioc_transfer:
@@ -40,32 +47,83 @@ cdef extern from "linux/spi/spidev.h":
     cdef int SPI_IOC_WR_MODE, SPI_IOC_WR_BITS_PER_WORD, SPI_IOC_WR_MAX_SPEED_HZ
 
 cdef class SPI:
+    '''
+    Communication with the IT8951 over SPI.
+
+    Unless backend is given, /dev/spidev<bus>.<device> is used for the transfers, and
+    the RESET and HRDY pins are operated with RPi.GPIO. Otherwise, backend must be an
+    object with the following methods, which are used instead:
+
+     - transfer(data, speed_hz): perform one SPI transaction (with chip select held
+       for its whole length), sending the bytes data and returning the bytes received
+     - hrdy(): the state of the HRDY pin
+     - wait_hrdy(timeout): block until HRDY is set, or timeout seconds have passed
+     - reset(): pulse the RESET pin
+
+    and optionally the attribute max_block_size, the largest transfer it supports.
+    '''
     cdef int fd, _mode, _bits_per_word, data_hz, cmd_hz, delay
-    cdef int max_block_size
+    cdef readonly int max_block_size
     cdef float timeout_secs
+    cdef public float spin_secs
+    cdef public double last_wait_secs
+    cdef public bint overlap_packing
 
-    cdef unsigned char [:] write_buf, read_buf
+    # running totals for instrumentation, only kept while collect_stats is set
+    cdef public bint collect_stats
+    cdef public double hrdy_secs, transfer_secs, pack_secs
+    cdef public long long bytes_sent
+
+    cdef unsigned char [:] write_buf, write_buf2, read_buf
+    cdef object _sender
+    cdef readonly object backend
+
+    def __cinit__(self, bus=0, device=0, int cmd_hz=1000000, int data_hz=24000000, float timeout_secs=5,
+                  float spin_secs=0.0002, bint overlap_packing=True, backend=None):
+        global GPIO
 
-    def __cinit__(self, bus=0, device=0, int cmd_hz=1000000, int data_hz=24000000, float timeout_secs=5):
         self.fd = -1
-        fd_path = '/dev/spidev{}.{}'.format(bus, device)
-        self.fd = os.open(fd_path, os.O_RDWR)
+        self.backend = backend
+        self._sender = None
+
+        if backend is None:
+            import RPi.GPIO
+            GPIO = RPi.GPIO
 
-        self._set_max_block_size()
+            fd_path = '/dev/spidev{}.{}'.format(bus, device)
+            self.fd = os.open(fd_path, os.O_RDWR)
+            self._set_max_block_size()
+        else:
+            self.max_block_size = getattr(backend, 'max_block_size', 4096)
 
         # pre-allocate buffers so we aren't reallocating them all the time
         self.write_buf = cython.view.array(shape=(self.max_block_size,), itemsize=sizeof(unsigned char), format='B')
         self.read_buf  = cython.view.array(shape=(self.max_block_size,), itemsize=sizeof(unsigned char), format='B')
 
+        # second transmit buffer, so that one block of pixels can be packed while the
+        # previous one is being sent (see pack_and_write_pixels)
+        self.write_buf2 = cython.view.array(shape=(self.max_block_size,), itemsize=sizeof(unsigned char), format='B')
+        self.overlap_packing = overlap_packing
+
         # the default spi frequency is way too fast; also it seems that we can set the SPI frequency for data transfer
         # to be a lot higher than for sending commands
         self.cmd_hz = cmd_hz
         self.data_hz = data_hz
 
         self.timeout_secs = timeout_secs
+        self.spin_secs = spin_secs
+        self.last_wait_secs = 0
 
         self.delay = 0
 
+        if backend is not None:
+            self._bits_per_word = 8
+            backend.reset()
+            return
+
+        # read this once, rather than with an ioctl on every transfer
+        self._bits_per_word = self.bits_per_word
+
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False)
         GPIO.setup(Pins.HRDY, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
@@ -77,8 +135,10 @@ cdef class SPI:
         GPIO.output(Pins.RESET, GPIO.HIGH)
 
     def __del__(self):
-        GPIO.cleanup([Pins.HRDY, Pins.RESET])
+        if self._sender is not None:
+            self._sender.shutdown()
         if self.fd != -1:
+            GPIO.cleanup([Pins.HRDY, Pins.RESET])
             os.close(self.fd)
 
     def _set_max_block_size(self):
@@ -100,43 +160,128 @@ cdef class SPI:
 
     def wait_ready(self):
         '''
-        Wait for the device's ready pin to be set
+        Wait for the device's ready pin to be set. Returns the time waited in seconds,
+        which is also stored in the last_wait_secs attribute.
+
+        The pin is first polled in a tight loop for spin_secs, which catches the common
+        case of the device becoming ready almost immediately. After that, we block
+        until the pin's rising edge, so that we neither use the CPU nor add latency.
         '''
-        start = time()
-        while not GPIO.input(Pins.HRDY):
-            if time()-start > self.timeout_secs:
+        if self._hrdy():
+            self.last_wait_secs = 0
+            return 0.0
+
+        start = perf_counter()
+
+        while perf_counter()-start < self.spin_secs:
+            if self._hrdy():
+                return self._finish_wait(start)
+
+        while not self._hrdy():
+            remaining = self.timeout_secs - (perf_counter()-start)
+            if remaining <= 0:
                 raise TimeoutError("Timed out waiting for display to respond")
-            sleep(0.001)
+
+            # wake up every so often, in case the edge came between checking the
+            # pin and starting to wait for it
+            if self.backend is not None:
+                self.backend.wait_hrdy(min(remaining, 0.01))
+            else:
+                GPIO.wait_for_edge(Pins.HRDY, GPIO.RISING, timeout=max(1, int(1000*min(remaining, 0.01))))
+
+        return self._finish_wait(start)
+
+    cdef bint _hrdy(self):
+        if self.backend is not None:
+            return self.backend.hrdy()
+        return GPIO.input(Pins.HRDY)
+
+    def _finish_wait(self, start):
+        self.last_wait_secs = perf_counter()-start
+        if self.collect_stats:
+            self.hrdy_secs += self.last_wait_secs
+        return self.last_wait_secs
+
+    def get_stats(self):
+        '''
+        The totals kept while collect_stats is True: seconds spent waiting for HRDY,
+        in SPI transfers and packing pixels, and the number of bytes sent
+        '''
+        return {
+            'hrdy_wait': self.hrdy_secs,
+            'transfer': self.transfer_secs,
+            'pack': self.pack_secs,
+            'bytes': self.bytes_sent,
+        }
+
+    def reset_stats(self):
+        self.hrdy_secs = self.transfer_secs = self.pack_secs = 0
+        self.bytes_sent = 0
 
     def transfer(self, int size, int speed):
         '''
         Perform an SPI transaction of *size* bytes on the preallocated read and write buffers.
         '''
+        self._transfer_from(self.write_buf, size, speed)
+
+    def _transfer_from(self, unsigned char [:] tx_buf, int size, int speed):
+        '''
+        Perform an SPI transaction of *size* bytes from tx_buf. The GIL is released
+        during the transfer itself.
+        '''
         cdef spi_ioc_transfer tr
+        cdef int result
+        cdef int fd = self.fd
+        cdef int request = SPI_IOC_MESSAGE(1)
+        cdef double start = 0
 
         self.wait_ready()
 
+        if self.collect_stats:
+            start = perf_counter()
+
+        if self.backend is not None:
+            self._backend_transfer(tx_buf[:size], self.read_buf[:size], speed)
+            self._count_transfer(start, size)
+            return
+
         memset(&tr, 0, sizeof(tr))
 
         # set up our transmit and receive buffers
         tr.rx_buf = <unsigned long>&(self.read_buf[0])
-        tr.tx_buf = <unsigned long>&(self.write_buf[0])
+        tr.tx_buf = <unsigned long>&(tx_buf[0])
 
         # set the other transfer parameters
         tr.len = size
         tr.delay_usecs = self.delay
         tr.speed_hz = speed
-        tr.bits_per_word = self.bits_per_word
+        tr.bits_per_word = self._bits_per_word
 
         #print('w:', ','.join(hex(x) for x in write_buf))
 
-        result = ioctl(self.fd, SPI_IOC_MESSAGE(1), &tr);
+        with nogil:
+            result = ioctl(fd, request, &tr)
 
         #print('r:', ','.join(hex(x) for x in read_buf))
 
         if result < 1:
             raise IOError("spi transfer failed with result {}".format(result))
 
+        self._count_transfer(start, size)
+
+    cdef inline void _count_transfer(self, double start, int size):
+        if self.collect_stats:
+            self.transfer_secs += perf_counter()-start
+            self.bytes_sent += size
+
+    cdef _backend_transfer(self, unsigned char [:] tx, unsigned char [:] rx, int speed):
+        received = self.backend.transfer(bytes(tx), speed)
+        cdef const unsigned char [:] rx_view = received
+        if rx_view.shape[0] != rx.shape[0]:
+            raise IOError("backend returned {} bytes instead of {}".format(rx_view.shape[0], rx.shape[0]))
+        if rx.shape[0]:
+            memcpy(&rx[0], &rx_view[0], rx.shape[0])
+
     def read(self, int preamble, int count):
         '''
         Send preamble, and return a buffer of 16-bit unsigned ints of length count
@@ -160,6 +305,23 @@ cdef class SPI:
 
         return rtn
 
+    def read_into(self, int preamble, unsigned char [:] out):
+        '''
+        Send preamble, and read len(out) bytes of data into out, as they are received
+        (each 16-bit word most significant byte first). The length must be even, and
+        at most max_block_size-4 bytes. This avoids converting large reads to ints.
+        '''
+        cdef int n = out.shape[0]
+        if n % 2 or n+4 > self.max_block_size:
+            raise ValueError("read length must be even and at most {} bytes".format(self.max_block_size-4))
+
+        self.write_buf[0] = preamble >> 8
+        self.write_buf[1] = preamble & 0xFF
+
+        self.transfer(n+4, speed=self.cmd_hz)
+
+        out[:] = self.read_buf[4:4+n]
+
     def write(self, int preamble, ary):
         '''
         Send preamble, and then write the data in ary (16-bit unsigned ints) over SPI
@@ -176,41 +338,82 @@ cdef class SPI:
 
         self.transfer(buflen, speed=self.cmd_hz)
 
-    @cython.boundscheck(False)
-    @cython.wraparound(False)
-    @cython.initializedcheck(False)
     @cython.cdivision(True)
-    def pack_and_write_pixels(self, const unsigned char [:] pixbuf, int bpp):
+    def pack_and_write_pixels(self, pixbuf, int bpp, box=None, stride=None):
         '''
         Pack pixels into a byte buffer, and write them to the device. Pixbuf should be
         an array with each value an individual pixel, in the range 0x00-0xFF.
+
+        If box is given, only the pixels inside that rectangle of pixbuf are sent, row
+        by row. pixbuf can then be a whole frame: a PIL image, a 2D array, or a flat
+        buffer with rows of stride bytes (see img_manip.pixel_view). The pixels are
+        packed directly from it into the transmit buffer.
+
+        Data that doesn't fit in one SPI transfer is sent in blocks. Unless
+        overlap_packing is False, each block is sent from a background thread while
+        the next one is packed into the other transmit buffer. Neither step holds the
+        GIL, so other Python threads can run during the transfer too.
         '''
-        cdef int pix_count, nbytes, i, byte_idx, pix_shift, block_start, t
+        cdef long start, total
+        cdef int nbytes, pix_count
         cdef int preamble = 0x0000
         cdef int pix_per_byte = 8 // bpp
-        cdef int pixbuf_len = len(pixbuf)
+        cdef unsigned char [:] buf
+        cdef int k = 0
+        cdef double pack_start = 0
+
+        if box is None:
+            total = len(pixbuf)
+        else:
+            total = (box[2]-box[0])*(box[3]-box[1])
 
         # transfer only full 16 bit words
         cdef int pix_per_block = 2*pix_per_byte * ((self.max_block_size - 2)//2)
 
-        for block_start in range(0, pixbuf_len, pix_per_block):
-            pix_count = min(pix_per_block, pixbuf_len-block_start)
+        cdef bint overlap = self.overlap_packing and total > pix_per_block
+        if overlap and self._sender is None:
+            self._sender = ThreadPoolExecutor(max_workers=1, thread_name_prefix='IT8951 SPI')
+
+        # the transfer of the previous block, if it is in progress
+        sending = None
+
+        try:
+            for start in range(0, total, pix_per_block):
+                # alternate between the transmit buffers. a buffer is only reused once
+                # the transfer from it (two blocks ago) has been waited for
+                buf = self.write_buf2 if k % 2 else self.write_buf
+                k += 1
+
+                buf[0] = preamble >> 8
+                buf[1] = preamble & 0xFF
+
+                if self.collect_stats:
+                    pack_start = perf_counter()
+
+                pix_count = pack_pixels(pixbuf, buf[2:2+pix_per_block//pix_per_byte],
+                                        bpp, box=box, start=start, stride=stride)
 
-            self.write_buf[0] = preamble >> 8
-            self.write_buf[1] = preamble & 0xFF
+                if self.collect_stats:
+                    self.pack_secs += perf_counter()-pack_start
 
-            # TODO: make the following more readable
-            nbytes = 2 + 2*((pix_count+2*pix_per_byte-1)//(2*pix_per_byte))
-            for byte_idx in range(2, nbytes):
-                t = 0
-                for i in range(pix_per_byte):
-                    pix_idx = block_start + (byte_idx-2)*pix_per_byte + i
-                    t <<= bpp
-                    t |= pixbuf[pix_idx] >> (8-bpp)
-                self.write_buf[byte_idx] = t
+                # pad out to a full word
+                nbytes = 2 + 2*((pix_count+2*pix_per_byte-1)//(2*pix_per_byte))
+                if (pix_count+pix_per_byte-1)//pix_per_byte < nbytes-2:
+                    buf[nbytes-1] = 0
 
-            # it seems we can crank up the SPI speed here somewhat
-            self.transfer(nbytes, speed=self.data_hz)
+                # it seems we can crank up the SPI speed here somewhat
+                if not overlap:
+                    self._transfer_from(buf, nbytes, self.data_hz)
+                    continue
+
+                if sending is not None:
+                    sending.result()
+                sending = self._sender.submit(self._transfer_from, buf, nbytes, self.data_hz)
+
+        finally:
+            # don't return (or let the buffers be reused) while a transfer is in progress
+            if sending is not None:
+                sending.result()
 
     ##### higher level read/write functions
 
@@ -226,10 +429,14 @@ cdef class SPI:
 
         args : list(int), optional
             Arguments for the command
+
+        The arguments are all sent in one data transaction after the command, so that
+        a command takes two transactions (each waiting for HRDY) however many
+        arguments it has.
         '''
         self.write(0x6000, [cmd])  # 0x6000 is preamble
-        for arg in args:
-            self.write_data([arg])
+        if args:
+            self.write_data(args)
 
     def write_data(self, ary):
         '''
@@ -255,6 +462,13 @@ cdef class SPI:
         '''
         return self.read(0x1000, n)
 
+    def read_data_into(self, out):
+        '''
+        Read len(out)//2 16-bit words of data from the device into the byte buffer out
+        (see read_into)
+        '''
+        self.read_into(0x1000, out)
+
     def read_int(self):
         '''
         Read a single 16 bit int from the device
@@ -0,0 +1,206 @@
+'''
+This file contains a class that runs the draws of an AutoDisplay on a background
+thread, so that the caller doesn't have to wait for the transfer and refresh.
+'''
+
+from concurrent.futures import Future, wait
+from threading import Condition, Thread
+
+from PIL import Image
+
+from .constants import DisplayModes
+from . import img_manip
+
+
+class UpdateWorker:
+    '''
+    Hands the draws of an AutoDisplay off to a dedicated thread.
+
+    Drawing is done on this object's own frame_buf, instead of the display's. The
+    draw methods take a snapshot of it and return immediately with a
+    concurrent.futures.Future, which completes once the display has been updated
+    (use its result() method to wait for it, or add_done_callback to be notified).
+
+    Draws requested while the worker is busy are coalesced: a run of queued draws
+    with the same mode becomes a single update of the frame as it was at the last of
+    them, which covers all the regions that changed in the meantime. Their futures
+    all complete when that update does. A draw in another mode starts a new run, so
+    it isn't affected by what is drawn for the ones after it.
+
+    The display must not be used directly while the worker is running. Call close
+    (or use the worker as a context manager) to finish the queued draws and stop
+    the thread.
+
+    Parameters
+    ----------
+
+    display : AutoDisplay
+        The display to draw on
+    '''
+
+    def __init__(self, display):
+        self.display = display
+
+        # what the caller draws on
+        self.frame_buf = display.frame_buf.copy()
+
+        # list of [full, mode, futures, damage, snapshot] entries waiting to be drawn,
+        # and the futures of the one being drawn. each entry has its own snapshot of
+        # frame_buf, from the latest request merged into it, so that a draw never shows
+        # what was drawn for a later one in a different mode. snapshots of entries that
+        # have been drawn are kept in _spare, to be reused
+        self._queue = []
+        self._spare = []
+        self._running = []
+        self._closed = False
+        self._cond = Condition()
+
+        # the boxes passed to invalidate since the last draw request
+        self._damage = None
+
+        self._thread = Thread(target=self._run, name='IT8951 update worker', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def width(self):
+        return self.frame_buf.width
+
+    @property
+    def height(self):
+        return self.frame_buf.height
+
+    def draw_full(self, mode):
+        '''
+        Queue writing the full image to the device, and displaying it using mode.
+        Returns a Future.
+        '''
+        return self._submit(True, mode)
+
+    def draw_partial(self, mode):
+        '''
+        Queue an update of the parts of the image that have changed since the last
+        draw. Returns a Future.
+        '''
+        return self._submit(False, mode)
+
+    def invalidate(self, box=None):
+        '''
+        Report that the area box of frame_buf has been drawn on, or all of it if box is
+        None (see AutoDisplay.invalidate). Applies to the next draw requested.
+        '''
+        if box is None:
+            box = (0, 0, self.width, self.height)
+
+        with self._cond:
+            if self._damage is None:
+                self._damage = []
+            self._damage.append(tuple(box))
+
+    def clear(self):
+        '''
+        Clear the frame buffer, and queue clearing the display. Returns a Future.
+        '''
+        self.frame_buf.paste(0xFF, box=(0, 0, self.width, self.height))
+        return self.draw_full(DisplayModes.INIT)
+
+    def flush(self, timeout=None):
+        '''
+        Wait for all the draws queued so far to finish. Returns True if they did, or
+        False if timeout (in seconds) ran out first.
+        '''
+        with self._cond:
+            futures = [f for entry in self._queue for f in entry[2]]
+            futures += self._running
+
+        return not wait(futures, timeout=timeout).not_done
+
+    def close(self):
+        '''
+        Finish the queued draws, and stop the worker thread
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _submit(self, full, mode):
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('cannot draw after the worker has been closed')
+
+            damage, self._damage = self._damage, None
+
+            # a full draw sends the whole frame, so all of it has to be up to date
+            if full:
+                damage = None
+
+            if self._queue and self._queue[-1][1] == mode:
+                entry = self._queue[-1]
+                entry[0] = entry[0] or full
+                entry[2].append(future)
+
+                # a merged draw has to look everywhere either of them would have
+                if entry[3] is None or damage is None:
+                    entry[3] = None
+                else:
+                    entry[3] += damage
+            else:
+                if self._spare:
+                    snapshot = self._spare.pop()
+                else:
+                    snapshot = Image.new(self.frame_buf.mode, self.frame_buf.size)
+                entry = [full, mode, [future], damage, snapshot]
+                self._queue.append(entry)
+
+            # only the areas that will be copied to the display need to be up to date
+            if damage is None:
+                img_manip.copy_region(self.frame_buf, entry[4])
+            else:
+                for box in damage:
+                    img_manip.copy_region(self.frame_buf, entry[4], box)
+
+            self._cond.notify()
+
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+
+                if not self._queue:
+                    return
+
+                full, mode, futures, damage, snapshot = self._queue.pop(0)
+                if damage is None:
+                    img_manip.copy_region(snapshot, self.display.frame_buf)
+                else:
+                    for box in damage:
+                        img_manip.copy_region(snapshot, self.display.frame_buf, box)
+                        self.display.invalidate(box)
+                self._spare.append(snapshot)
+                self._running = futures
+
+            futures = [f for f in futures if f.set_running_or_notify_cancel()]
+            if not futures:
+                continue
+
+            try:
+                if full:
+                    self.display.draw_full(mode)
+                else:
+                    self.display.draw_partial(mode)
+            except Exception as e:
+                for f in futures:
+                    f.set_exception(e)
+            else:
+                for f in futures:
+                    f.set_result(None)
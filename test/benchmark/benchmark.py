@@ -0,0 +1,288 @@
+'''
+Benchmarks for the update pipeline, which run without a device.
+
+The end-to-end benchmarks drive an AutoEPDDisplay over a simulated IT8951 (see
+IT8951.sim). By default the simulated device takes no time to transfer or display
+anything, so they measure the time spent on the host; pass --device-timing to also
+model the SPI clock and the LUT engines.
+
+Results are written as JSON, and can be compared with those from another commit:
+
+    python benchmark.py -o before.json
+    (check out and build another commit)
+    python benchmark.py -o after.json --compare before.json
+'''
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+from time import perf_counter
+
+from PIL import Image, ImageDraw, ImageFont
+
+from IT8951 import img_manip
+from IT8951.constants import DisplayModes
+from IT8951.display import AutoDisplay, AutoEPDDisplay
+from IT8951.interface import EPD
+from IT8951.sim import SimulatedIT8951, DEFAULT_UPDATE_TIMES
+
+# sizes of some common panels
+PANEL_SIZES = {
+    '6in'   : (800, 600),
+    '7.8in' : (1872, 1404),
+    '9.7in' : (1200, 825),
+}
+
+BENCHMARKS = {}
+
+def benchmark(name):
+    '''
+    Register a benchmark. It is called with the panel dimensions and the parsed
+    arguments, and should return a function that runs one iteration, plus a function
+    returning a dict of running totals (or None). The increase in the totals is
+    recorded per iteration.
+    '''
+    def register(f):
+        BENCHMARKS[name] = f
+        return f
+    return register
+
+def make_image(dims, seed=0):
+    img = Image.effect_noise(dims, 64 + seed)
+    draw = ImageDraw.Draw(img)
+    for i in range(0, dims[0]-40, 97):
+        y = (7*i) % (dims[1]-60)
+        draw.rectangle((i, y, i+40, y+60), fill=(seed*40) % 256)
+    return img
+
+def make_display(dims, args, **kwargs):
+    if args.device_timing:
+        sim = SimulatedIT8951(dims=dims, update_times=DEFAULT_UPDATE_TIMES,
+                              hrdy_time=0.00002, transfer_time=True)
+    else:
+        sim = SimulatedIT8951(dims=dims, update_times=0)
+    epd = EPD(vcom=-2.0, backend=sim)
+    display = AutoEPDDisplay(epd=epd, **kwargs)
+    display.clear()
+    epd.wait_display_ready()
+    return display, sim
+
+def device_totals(display, sim):
+    def totals():
+        display.epd.wait_display_ready()
+        return {'bytes_transferred': sim.bytes_transferred, 'display_updates': len(sim.displays)}
+    return totals
+
+##### the stages of the pipeline
+
+@benchmark('diff_box')
+def bench_diff_box(dims, args):
+    a = make_image(dims)
+    b = a.copy()
+    b.paste(0x00, box=(dims[0]//2, dims[1]//2, dims[0]//2+24, dims[1]//2+20))
+    return lambda: AutoDisplay._compute_diff_box(a, b), None
+
+@benchmark('diff_regions')
+def bench_diff_regions(dims, args):
+    display = AutoDisplay(*dims)
+    a = make_image(dims)
+    b = a.copy()
+    for x in range(0, dims[0], dims[0]//4):
+        b.paste(0x00, box=(x, 100, x+24, 120))
+    return lambda: display._compute_diff_regions(a, b), None
+
+@benchmark('rotate')
+def bench_rotate(dims, args):
+    display = AutoDisplay(*dims, rotate='CW', mirror=True)
+    display.frame_buf.paste(make_image(display.frame_buf.size))
+    return lambda: display._get_frame_buf(), None
+
+@benchmark('make_changes_bw')
+def bench_make_changes_bw(dims, args):
+    prev = make_image(dims)
+    new = make_image(dims, seed=1)
+    work = new.copy()
+
+    def run():
+        work.paste(new)
+        img_manip.make_changes_bw(prev, work)
+    return run, None
+
+def bench_pack(bpp):
+    def setup(dims, args):
+        img = make_image(dims)
+        out = bytearray(dims[0]*dims[1]*bpp//8)
+        return lambda: img_manip.pack_pixels(img, out, bpp), None
+    return setup
+
+for bpp in (1, 2, 4, 8):
+    benchmark('pack_{}bpp'.format(bpp))(bench_pack(bpp))
+
+##### end-to-end workloads
+
+@benchmark('draw_full')
+def bench_draw_full(dims, args):
+    # swapping between two full screen images
+    display, sim = make_display(dims, args)
+    images = [make_image(dims, seed) for seed in range(2)]
+    count = [0]
+
+    def run():
+        count[0] += 1
+        display.frame_buf.paste(images[count[0] % 2])
+        display.draw_full(DisplayModes.GC16)
+    return run, device_totals(display, sim)
+
+@benchmark('typing')
+def bench_typing(dims, args):
+    # one character at a time, like someone typing
+    display, sim = make_display(dims, args)
+    font = ImageFont.load_default()
+    draw = ImageDraw.Draw(display.frame_buf)
+    char_w, char_h = 12, 20
+    cols, rows = display.width//char_w, display.height//char_h
+    count = [0]
+
+    def run():
+        n = count[0]
+        count[0] += 1
+        x, y = (n % cols)*char_w, ((n//cols) % rows)*char_h
+        draw.rectangle((x, y, x+char_w-1, y+char_h-1), fill=0xFF)
+        draw.text((x, y), 'typing'[n % 6], font=font, fill=0x00)
+        display.draw_partial(DisplayModes.DU)
+    return run, device_totals(display, sim)
+
+@benchmark('clock')
+def bench_clock(dims, args):
+    # a clock face in the corner, changing every tick
+    display, sim = make_display(dims, args)
+    font = ImageFont.load_default()
+    draw = ImageDraw.Draw(display.frame_buf)
+    count = [0]
+
+    def run():
+        count[0] += 1
+        t = count[0]
+        draw.rectangle((20, 20, 220, 60), fill=0xFF)
+        draw.text((30, 30), '{:02d}:{:02d}:{:02d}'.format(t//3600 % 24, t//60 % 60, t % 60),
+                  font=font, fill=0x00)
+        display.draw_partial(DisplayModes.GL16)
+    return run, device_totals(display, sim)
+
+@benchmark('scroll')
+def bench_scroll(dims, args):
+    # the whole screen moving up by a line of text
+    display, sim = make_display(dims, args)
+    display.frame_buf.paste(make_image(dims))
+    display.draw_full(DisplayModes.GC16)
+    line = 20
+
+    def run():
+        buf = display.frame_buf
+        buf.paste(buf.crop((0, line, buf.width, buf.height)), box=(0, 0))
+        buf.paste(0xFF, box=(0, buf.height-line, buf.width, buf.height))
+        display.draw_partial(DisplayModes.GC16)
+    return run, device_totals(display, sim)
+
+##### running and reporting
+
+def run_benchmark(setup, dims, args):
+    run, totals = setup(dims, args)
+    if totals is not None:
+        before = totals()
+
+    # one iteration to warm up
+    run()
+
+    times = []
+    start = perf_counter()
+    while len(times) < args.min_iterations or perf_counter()-start < args.min_time:
+        t0 = perf_counter()
+        run()
+        times.append(perf_counter()-t0)
+
+    times.sort()
+    result = {
+        'iterations': len(times),
+        'min': times[0],
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+        'p90': times[int(0.9*(len(times)-1))],
+    }
+    if totals is not None:
+        after = totals()
+        result.update({k: (after[k]-before[k])/(len(times)+1) for k in after})
+    return result
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    print('{:<32} {:>12} {:>12} {:>8}'.format('benchmark', 'before (ms)', 'after (ms)', 'ratio'))
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['median']
+        after = result['median']
+        print('{:<32} {:>12.3f} {:>12.3f} {:>8.2f}'.format(name, 1000*before, 1000*after, after/before))
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Benchmark the update pipeline without a device')
+    p.add_argument('-b', '--benchmarks', nargs='+', choices=sorted(BENCHMARKS),
+                   default=sorted(BENCHMARKS), help='the benchmarks to run (default all)')
+    p.add_argument('-s', '--sizes', nargs='+', choices=sorted(PANEL_SIZES),
+                   default=sorted(PANEL_SIZES), help='the panel sizes to run at (default all)')
+    p.add_argument('-o', '--output', help='file to write the results to, as JSON')
+    p.add_argument('-c', '--compare', help='JSON results of an earlier run to compare with')
+    p.add_argument('--min-time', type=float, default=0.5,
+                   help='minimum time in seconds to run each benchmark for')
+    p.add_argument('--min-iterations', type=int, default=5,
+                   help='minimum number of times to run each benchmark')
+    p.add_argument('--device-timing', action='store_true',
+                   help='simulate the time the device takes to transfer and display')
+    p.add_argument('-t', '--threads', type=int, default=1,
+                   help='number of threads for the image kernels (0 for one per CPU, '
+                        'see img_manip.set_num_threads)')
+    return p.parse_args()
+
+def main():
+    args = parse_args()
+    img_manip.set_num_threads(args.threads)
+
+    results = {
+        'commit': git_commit(),
+        'python': sys.version,
+        'machine': platform.machine(),
+        'device_timing': args.device_timing,
+        'threads': img_manip.get_num_threads() if img_manip.PARALLEL else 1,
+        'results': {},
+    }
+
+    for size in args.sizes:
+        dims = PANEL_SIZES[size]
+        for name in args.benchmarks:
+            key = '{}[{}]'.format(name, size)
+            result = run_benchmark(BENCHMARKS[name], dims, args)
+            results['results'][key] = result
+            print('{:<32} {:>10.3f} ms'.format(key, 1000*result['median']), file=sys.stderr)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
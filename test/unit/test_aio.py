@@ -0,0 +1,81 @@
+import asyncio
+from PIL import Image
+
+from IT8951.aio import AsyncEPD, AsyncAutoEPDDisplay
+from IT8951.constants import DisplayModes
+from IT8951.metrics import Metrics
+
+from test_display import FakeEPD, quantize
+
+
+def test_async_display():
+
+    async def draw(display, offset):
+        display.frame_buf.paste(0x80, box=(0, 0, display.width, display.height//2))
+        await display.draw_full(DisplayModes.GC16)
+        for x in range(offset, 600, 100):
+            display.frame_buf.paste(0x00, box=(x, 100, x+40, 140))
+            display.frame_buf.paste(0xF0, box=(x, 400, x+40, 440))
+            await display.draw_partial(DisplayModes.GC16)
+
+        # the last update might still be running
+        assert display.epd.epd.engines
+        await display.epd.wait_display_ready()
+        assert not display.epd.epd.engines
+
+    async def main():
+        # several displays can be driven from one event loop
+        displays = [
+            AsyncAutoEPDDisplay(epd=FakeEPD()),
+            AsyncAutoEPDDisplay(epd=AsyncEPD(FakeEPD()), rotate='CW'),
+        ]
+        await asyncio.gather(*(draw(d, 10*i) for i, d in enumerate(displays)))
+        return displays
+
+    for display in asyncio.run(main()):
+        expected = display.frame_buf
+        if display._device_rotate_method is not None:
+            expected = expected.transpose(display._device_rotate_method)
+        assert quantize(display.epd.epd.screen, 4) == quantize(expected, 4)
+        assert display.epd.epd.max_concurrent > 1
+
+def test_async_slots():
+    records = []
+
+    async def main():
+        metrics = Metrics(callback=records.append)
+        display = AsyncAutoEPDDisplay(epd=FakeEPD(), frame_slots=2, metrics=metrics)
+        await display.draw_full(DisplayModes.GC16)
+
+        page = Image.new('L', display.frame_buf.size, 0xFF)
+        page.paste(0x00, box=(10, 10, 60, 60))
+        await display.preload(1, page)
+
+        display.epd.epd.calls.clear()
+        await display.show_slot(1, DisplayModes.GC16)
+        assert 'load' not in display.epd.epd.calls
+        await display.epd.wait_display_ready()
+        return display
+
+    display = asyncio.run(main())
+    assert quantize(display.epd.epd.screen, 4) == quantize(display.frame_buf, 4)
+    assert {'lut_wait', 'load', 'display'} <= set(records[0].stages)
+
+def test_async_shared_display():
+    # made outside the event loop, and drawn on from several tasks at once
+    display = AsyncAutoEPDDisplay(epd=FakeEPD())
+    order = []
+
+    async def draw(x):
+        display.frame_buf.paste(0x00, box=(x, 100, x+40, 140))
+        await display.draw_partial(DisplayModes.GC16)
+        order.append(x)
+
+    async def main():
+        await display.clear()
+        await asyncio.gather(*(draw(x) for x in range(0, 600, 100)))
+        await display.epd.wait_display_ready()
+
+    asyncio.run(main())
+    assert order == list(range(0, 600, 100))
+    assert quantize(display.epd.epd.screen, 4) == quantize(display.frame_buf, 4)
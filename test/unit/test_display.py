@@ -0,0 +1,493 @@
+import pytest
+from PIL import Image
+
+from IT8951.display import AutoDisplay, AutoEPDDisplay
+from IT8951.constants import DisplayModes, PixelModes, Rotate
+from IT8951 import regions, img_manip
+
+DIMS = (800, 600)
+
+class RecordingDisplay(AutoDisplay):
+    '''
+    An AutoDisplay that just records the updates it is asked to do
+    '''
+    def __init__(self, *args, **kwargs):
+        AutoDisplay.__init__(self, *args, **kwargs)
+        self.updates = []
+        self.screen = Image.new('L', self.display_dims, 0x00)
+
+    def update(self, data, xy, dims, mode):
+        self.updates.append((xy, dims, mode))
+        self.screen.paste(Image.frombytes('L', dims, bytes(data)), box=xy)
+
+    def expected_screen(self):
+        if self._rotate_method is None:
+            return self.frame_buf
+        return self.frame_buf.transpose(self._rotate_method)
+
+def make_display(**kwargs):
+    display = RecordingDisplay(*DIMS, **kwargs)
+    display.draw_full(DisplayModes.GC16)
+    display.updates.clear()
+    return display
+
+def test_no_changes():
+    display = make_display()
+    display.draw_partial(DisplayModes.DU)
+    assert display.updates == []
+
+def test_distant_changes_split():
+    display = make_display()
+    display.frame_buf.paste(0x00, box=(10, 10, 50, 30))
+    display.frame_buf.paste(0x00, box=(700, 550, 790, 590))
+    display.draw_partial(DisplayModes.GC16)
+
+    assert sorted(display.updates) == [
+        ((8, 8), (44, 24), DisplayModes.GC16),
+        ((700, 548), (92, 44), DisplayModes.GC16),
+    ]
+
+def test_nearby_changes_merged():
+    display = make_display()
+    display.frame_buf.paste(0x00, box=(10, 10, 50, 30))
+    display.frame_buf.paste(0x00, box=(60, 10, 100, 30))
+    display.draw_partial(DisplayModes.GC16)
+
+    assert display.updates == [((8, 8), (92, 24), DisplayModes.GC16)]
+
+def test_single_region():
+    display = make_display(region_overhead=None)
+    display.frame_buf.paste(0x00, box=(10, 10, 50, 30))
+    display.frame_buf.paste(0x00, box=(700, 550, 790, 590))
+    display.draw_partial(DisplayModes.GC16)
+
+    assert display.updates == [((8, 8), (784, 584), DisplayModes.GC16)]
+
+@pytest.mark.parametrize('region_overhead', [None, 1000])
+def test_regions_inside_display(region_overhead):
+    # a height that isn't a multiple of the alignment
+    display = RecordingDisplay(1200, 825, region_overhead=region_overhead)
+    display.draw_full(DisplayModes.GC16)
+    display.updates.clear()
+
+    display.frame_buf.paste(0x00, box=(1190, 810, 1200, 825))
+    display.draw_partial(DisplayModes.DU)
+    assert display.updates == [((1184, 808), (16, 17), DisplayModes.DU)]
+
+@pytest.mark.parametrize('rotate', [None, 'CW', 'CCW', 'flip'])
+@pytest.mark.parametrize('mirror', [False, True])
+def test_rotation(rotate, mirror):
+    display = make_display(rotate=rotate, mirror=mirror)
+    display.frame_buf.paste(0x00, box=(10, 10, 50, 30))
+    display.frame_buf.paste(0x80, box=(display.width-90, display.height-50,
+                                       display.width-10, display.height-10))
+    display.draw_partial(DisplayModes.GC16)
+
+    assert len(display.updates) == 2
+    assert display.screen.tobytes() == display.expected_screen().tobytes()
+
+    # prev_frame should have been brought up to date
+    display.updates.clear()
+    display.draw_partial(DisplayModes.GC16)
+    assert display.updates == []
+
+@pytest.mark.parametrize('rotate', [None, 'CW'])
+def test_du_bw(rotate):
+    display = make_display(rotate=rotate, track_gray=True)
+    display.frame_buf.paste(0x80, box=(0, 0, display.width, display.height))
+    display.draw_full(DisplayModes.GC16)
+    display.updates.clear()
+
+    # changed pixels are drawn in black and white, the others are left alone
+    display.frame_buf.paste(0xC0, box=(10, 10, 50, 30))
+    display.frame_buf.paste(0x00, box=(20, 20, 30, 30))
+    display.frame_buf.paste(0x00, box=(200, 200, 240, 220))
+    display.draw_partial(DisplayModes.DU)
+
+    expected = display.frame_buf.copy()
+    expected.paste(0xF0, box=(10, 10, 50, 30))
+    expected.paste(0x00, box=(20, 20, 30, 30))
+    if display._rotate_method is not None:
+        expected = expected.transpose(display._rotate_method)
+    assert display.screen.tobytes() == expected.tobytes()
+
+    # only the region left showing the wrong gray level is redrawn by the next
+    # grayscale update
+    display.updates.clear()
+    display.draw_partial(DisplayModes.GC16)
+    assert len(display.updates) == 1
+    assert display.screen.tobytes() == display.expected_screen().tobytes()
+
+_word_tables = {}
+
+def unpack_words(data, bpp):
+    '''
+    Expand pixel data sent as 16-bit big endian words, first pixel in the most
+    significant bits, to one byte per pixel scaled to the full 8-bit range
+    '''
+    if bpp == 8:
+        return bytes(data)
+    if bpp not in _word_tables:
+        mask = (1 << bpp) - 1
+        shifts = range(16-bpp, -1, -bpp)
+        _word_tables[bpp] = [bytes(((w >> s) & mask)*0xFF//mask for s in shifts)
+                             for w in range(1 << 16)]
+    table = _word_tables[bpp]
+    return b''.join(table[(hi << 8) | lo] for hi, lo in zip(data[0::2], data[1::2]))
+
+class FakeEPD:
+    '''
+    Just enough of an EPD to check what AutoEPDDisplay sends to it. Loaded
+    images are rotated according to rotate_mode, as the device does.
+
+    Each display update keeps one of n_engines LUT engines busy until the status
+    has been read update_polls times. Loading into or displaying an area that an
+    update is still running on fails.
+    '''
+    n_engines = 4
+    update_polls = 5
+
+    rotations = {
+        Rotate.NONE : None,
+        Rotate.CW   : Image.Transpose.ROTATE_270,
+        Rotate.CCW  : Image.Transpose.ROTATE_90,
+        Rotate.FLIP : Image.Transpose.ROTATE_180,
+    }
+
+    bpps = {
+        PixelModes.M_2BPP : 2,
+        PixelModes.M_4BPP : 4,
+        PixelModes.M_8BPP : 8,
+    }
+
+    def __init__(self, dims=DIMS):
+        self.width, self.height = dims
+        self.memory = Image.new('L', dims, 0x00)
+        self.screen = Image.new('L', dims, 0x00)
+        self.img_buf_address = 0
+        self.buffers = {self.img_buf_address : self.memory}
+        self.pixel_formats = []
+        self.calls = []
+        self.engines = {}
+        self.max_concurrent = 0
+        self.packed_loads = 0
+
+    def wait_display_ready(self, timeout=None):
+        self.calls.append('wait')
+        self.engines.clear()
+
+    def get_lut_status(self):
+        for engine in list(self.engines):
+            self.engines[engine][1] -= 1
+            if not self.engines[engine][1]:
+                del self.engines[engine]
+        return sum(1 << engine for engine in self.engines)
+
+    def check_not_busy(self, box, address=0):
+        assert not any(regions.boxes_overlap(box, b) for b, _, a in self.engines.values()
+                       if a == address)
+
+    def frame_slot_address(self, slot):
+        return self.img_buf_address + (slot+1)*self.width*self.height
+
+    def load_img_area(self, buf, rotate_mode=Rotate.NONE, xy=None, dims=None, pixel_format=None,
+                      src_box=None, stride=None, address=0, packed=False):
+        self.calls.append('load')
+        self.pixel_formats.append(pixel_format)
+        bpp = self.bpps[pixel_format]
+
+        # each row is a whole number of 16-bit words, most significant pixel first
+        assert (dims[0]*bpp) % 16 == 0
+        data = bytearray(dims[0]*dims[1]*bpp//8)
+        if packed:
+            self.packed_loads += 1
+            byte_box = (src_box[0]*bpp//8, src_box[1], src_box[2]*bpp//8, src_box[3])
+            img_manip.pack_pixels(buf, data, 8, box=byte_box, stride=stride)
+        else:
+            img_manip.pack_pixels(buf, data, bpp, box=src_box, stride=stride)
+        img = Image.frombytes('L', dims, unpack_words(data, bpp))
+        method = self.rotations[rotate_mode]
+        if method is not None:
+            img = img.transpose(method)
+            if rotate_mode in (Rotate.CW, Rotate.CCW):
+                size = (self.height, self.width)
+            else:
+                size = (self.width, self.height)
+            box = (xy[0], xy[1], xy[0]+dims[0], xy[1]+dims[1])
+            xy = regions.transpose_box(box, method, size)[:2]
+        self.check_not_busy(xy + (xy[0]+img.width, xy[1]+img.height), address)
+        memory = self.buffers.setdefault(address, Image.new('L', self.memory.size))
+        memory.paste(img, box=xy)
+
+    def load_img_area_1bpp(self, buf, xy, dims, src_box=None, stride=None):
+        self.calls.append('load')
+        self.check_not_busy((xy[0]//8, xy[1], (xy[0]+dims[0])//8, xy[1]+dims[1]))
+        self.pixel_formats.append('1bpp')
+        data = bytearray(dims[0]*dims[1]//8)
+        img_manip.pack_pixels(buf, data, 1, box=src_box, stride=stride)
+        self.bitmap = (xy, Image.frombytes('1', dims, bytes(data)))
+
+    def display_area(self, xy, dims, display_mode):
+        self.display_area_buf(xy, dims, display_mode, self.img_buf_address)
+
+    def display_area_buf(self, xy, dims, display_mode, address):
+        self.calls.append('display')
+        box = (xy[0], xy[1], xy[0]+dims[0], xy[1]+dims[1])
+        self.check_not_busy(box, address)
+
+        engine = min(set(range(self.n_engines)) - set(self.engines))
+        self.engines[engine] = [box, self.update_polls, address]
+        self.max_concurrent = max(self.max_concurrent, len(self.engines))
+
+        self.screen.paste(self.buffers[address].crop(box), box=box)
+
+    def read_img_area(self, box=None, address=0):
+        if box is None:
+            box = (0, 0, self.width, self.height)
+        return self.buffers[address].crop(box)
+
+    def display_area_1bpp(self, xy, dims, display_mode, zero_gray=0x00, one_gray=0xF0):
+        assert not self.engines
+        assert self.bitmap[0] == xy and self.bitmap[1].size == dims
+        img = self.bitmap[1].convert('L').point(lambda p: one_gray if p else zero_gray)
+        self.screen.paste(img, box=xy)
+
+@pytest.mark.parametrize('rotate', [None, 'CW', 'CCW', 'flip'])
+@pytest.mark.parametrize('mirror', [False, True])
+def test_hw_rotation(rotate, mirror):
+    display = AutoEPDDisplay(epd=FakeEPD(), rotate=rotate, mirror=mirror)
+    assert (display._rotate_method is None) == (not mirror)
+
+    display.frame_buf.paste(0x40, box=(0, 0, display.width, display.height//2))
+    display.draw_full(DisplayModes.GC16)
+    display.frame_buf.paste(0x00, box=(10, 10, 50, 30))
+    display.frame_buf.paste(0x80, box=(display.width-90, display.height-50,
+                                       display.width-10, display.height-10))
+    display.draw_partial(DisplayModes.GC16)
+
+    reference = RecordingDisplay(*DIMS, rotate=rotate, mirror=mirror)
+    reference.frame_buf.paste(display.frame_buf)
+    assert quantize(display.epd.screen, 4) == quantize(reference.expected_screen(), 4)
+
+def quantize(img, bpp):
+    return img.point(lambda p: p >> (8-bpp)).tobytes()
+
+def test_2bpp():
+    display = AutoEPDDisplay(epd=FakeEPD())
+    display.frame_buf.paste(0x80, box=(0, 0, display.width, display.height//2))
+    display.draw_full(DisplayModes.GC16)
+
+    display.frame_buf.paste(0x00, box=(13, 10, 50, 30))
+    display.frame_buf.paste(0x40, box=(200, 300, 290, 305))
+    display.draw_partial(DisplayModes.A2)
+
+    assert display.epd.pixel_formats == [PixelModes.M_4BPP] + 2*[PixelModes.M_2BPP]
+    for box in [(8, 8, 56, 32), (200, 296, 296, 312)]:
+        assert quantize(display.epd.screen.crop(box), 2) == quantize(display.frame_buf.crop(box), 2)
+
+    # full frames with a width that isn't a multiple of 8 pixels are sent at 4bpp
+    display = AutoEPDDisplay(epd=FakeEPD((800, 604)), rotate='CW')
+    display.draw_full(DisplayModes.A2)
+    assert display.epd.pixel_formats == [PixelModes.M_4BPP]
+
+def test_quantize_diff():
+    display = AutoEPDDisplay(epd=FakeEPD())
+    display.frame_buf.paste(0x80, box=(0, 0, display.width, display.height//2))
+    display.draw_full(DisplayModes.GC16)
+    display.epd.calls.clear()
+
+    # changes that don't show at 4bpp are not drawn
+    display.frame_buf.paste(0x8C, box=(10, 10, 50, 30))
+    display.draw_partial(DisplayModes.GC16)
+    assert display.epd.calls == []
+
+    # nor ones that don't show at 2bpp, for low bpp modes
+    display.frame_buf.paste(0xB0, box=(10, 10, 50, 30))
+    display.draw_partial(DisplayModes.DU)
+    assert display.epd.calls == []
+
+    # but they add up
+    display.frame_buf.paste(0x90, box=(12, 12, 50, 30))
+    display.draw_partial(DisplayModes.GC16)
+    assert display.epd.calls == ['load', 'display']
+    assert quantize(display.epd.screen, 4) == quantize(display.frame_buf, 4)
+
+    display = AutoEPDDisplay(epd=FakeEPD(), quantize_diff=False)
+    display.draw_full(DisplayModes.GC16)
+    display.epd.calls.clear()
+    display.frame_buf.paste(0xF8, box=(10, 10, 50, 30))
+    display.draw_partial(DisplayModes.GC16)
+    assert display.epd.calls == ['load', 'display']
+
+@pytest.mark.parametrize('rotate', [None, 'CW'])
+def test_packed_shadow(rotate):
+    display = AutoEPDDisplay(epd=FakeEPD(), rotate=rotate, packed_shadow=True, track_gray=True)
+    display.frame_buf.paste(0x80, box=(0, 0, display.width, display.height//2))
+    display.draw_full(DisplayModes.GC16)
+    assert display.prev_frame.nbytes == display.width*display.height//2
+
+    for x in range(0, 400, 80):
+        display.frame_buf.paste(0x00, box=(x+10, 10, x+50, 30))
+        display.frame_buf.paste(0x8C, box=(x+10, 300, x+50, 330))
+        display.draw_partial(DisplayModes.GC16)
+        display.frame_buf.paste(0x40, box=(x+20, 20, x+30, 40))
+        display.draw_partial(DisplayModes.DU)
+    display.draw_partial(DisplayModes.GC16)
+
+    # the prev_frame is what was sent
+    frame = display.frame_buf
+    if rotate is not None:
+        frame = frame.transpose(Image.Transpose.ROTATE_270)
+    assert quantize(display.epd.screen, 4) == quantize(frame, 4)
+    expected = bytearray(display.width*display.height//2)
+    img_manip.pack_pixels(display.frame_buf, expected, 4)
+    assert display.prev_frame.tobytes() == bytes(expected)
+
+    # which the 4bpp updates were sent from (the device does the rotation)
+    assert display.epd.packed_loads > 0
+
+    # an update from frame_buf outside of a draw doesn't stop a later draw from
+    # syncing the same box
+    box = (32, 32, 64, 64)
+    display.frame_buf.paste(0x00, box=box)
+    display.update_region(display.frame_buf, box, box[:2], DisplayModes.GC16)
+    display.frame_buf.paste(0xF0, box=box)
+    display.draw_partial(DisplayModes.DU)
+    img_manip.pack_pixels(display.frame_buf, expected, 4)
+    assert display.prev_frame.tobytes() == bytes(expected)
+
+def test_1bpp():
+    display = AutoEPDDisplay(epd=FakeEPD(), use_1bpp=True)
+    display.frame_buf.paste(0x80, box=(0, 0, display.width, display.height//2))
+    display.draw_full(DisplayModes.GC16)
+
+    # black and white content is sent at 1bpp, in regions aligned to 32 pixels
+    display.frame_buf.paste(0x00, box=(100, 400, 120, 420))
+    display.frame_buf.paste(0xFF, box=(105, 405, 110, 410))
+    display.draw_partial(DisplayModes.A2)
+    assert display.epd.pixel_formats[1:] == ['1bpp']
+    box = (96, 400, 128, 424)
+    assert quantize(display.epd.screen.crop(box), 1) == quantize(display.frame_buf.crop(box), 1)
+
+    # but anything with gray in it is not
+    display.frame_buf.paste(0x00, box=(100, 100, 120, 120))
+    display.draw_partial(DisplayModes.A2)
+    assert display.epd.pixel_formats[2:] == [PixelModes.M_2BPP]
+
+    # nor anything rotated by the device
+    display = AutoEPDDisplay(epd=FakeEPD(), use_1bpp=True, rotate='CW')
+    display.draw_full(DisplayModes.GC16)
+    display.frame_buf.paste(0x00, box=(100, 400, 120, 420))
+    display.draw_partial(DisplayModes.A2)
+    assert display.epd.pixel_formats[1:] == [PixelModes.M_2BPP]
+
+def test_pipeline():
+    display = AutoEPDDisplay(epd=FakeEPD())
+    display.frame_buf.paste(0x80, box=(0, 0, display.width, display.height//2))
+    display.draw_full(DisplayModes.GC16)
+
+    # distant regions are loaded and displayed while the others are still running, and
+    # FakeEPD checks that nothing overlapping a running update is touched
+    for box in [(10, 10, 50, 30), (700, 550, 790, 590), (400, 10, 430, 40), (20, 10, 50, 30)]:
+        display.frame_buf.paste(0xF0, box=box)
+        display.frame_buf.paste(0x00, box=(box[0]+5, box[1]+5, box[2], box[3]))
+        display.draw_partial(DisplayModes.DU)
+
+    assert 'wait' not in display.epd.calls
+    assert display.epd.max_concurrent > 1
+    assert quantize(display.epd.screen, 2) == quantize(display.frame_buf, 2)
+
+    display = AutoEPDDisplay(epd=FakeEPD(), pipeline=False, concurrent=False)
+    display.draw_full(DisplayModes.GC16)
+    display.frame_buf.paste(0x40, box=(10, 10, 50, 30))
+    display.frame_buf.paste(0x40, box=(700, 550, 790, 590))
+    display.draw_partial(DisplayModes.DU)
+    assert display.epd.calls == 3*['wait', 'load', 'wait', 'display']
+    assert display.epd.max_concurrent == 1
+
+@pytest.mark.parametrize('rotate', [None, 'CW'])
+def test_frame_slots(rotate):
+    display = AutoEPDDisplay(epd=FakeEPD(), frame_slots=2, rotate=rotate)
+    display.draw_full(DisplayModes.GC16)
+
+    pages = []
+    for i in range(2):
+        page = Image.new('L', display.frame_buf.size, 0xFF)
+        page.paste(0x00, box=(10+100*i, 10, 60+100*i, 60))
+        display.preload(i, page)
+        pages.append(page)
+
+    def check_screen():
+        expected = display.frame_buf
+        if display._device_rotate_method is not None:
+            expected = expected.transpose(display._device_rotate_method)
+        assert quantize(display.epd.screen, 4) == quantize(expected, 4)
+
+    # showing a page doesn't send any pixels
+    display.epd.calls.clear()
+    for i in [1, 0, 1]:
+        display.show_slot(i, DisplayModes.GC16)
+        assert display.frame_buf.tobytes() == pages[i].tobytes()
+        check_screen()
+    assert 'load' not in display.epd.calls
+
+    # partial updates carry on from the page that is shown
+    display.frame_buf.paste(0x80, box=(200, 200, 240, 240))
+    display.draw_partial(DisplayModes.GC16)
+    check_screen()
+
+    with pytest.raises(ValueError):
+        display.preload(2)
+    with pytest.raises(ValueError):
+        AutoEPDDisplay(epd=FakeEPD(), frame_slots=2).show_slot(0, DisplayModes.GC16)
+
+@pytest.mark.parametrize('rotate', [None, 'CW'])
+@pytest.mark.parametrize('mirror', [False, True])
+def test_resync(rotate, mirror):
+    display = AutoEPDDisplay(epd=FakeEPD(), rotate=rotate, mirror=mirror)
+    display.frame_buf.paste(0x80, box=(0, 0, display.width, display.height//2))
+    display.frame_buf.paste(0x00, box=(10, 10, 50, 30))
+    display.draw_full(DisplayModes.GC16)
+
+    # start over with the same device, as after a restart
+    restarted = AutoEPDDisplay(epd=display.epd, rotate=rotate, mirror=mirror)
+    restarted.resync()
+    assert quantize(restarted.frame_buf, 4) == quantize(display.frame_buf, 4)
+
+    restarted.epd.calls.clear()
+    restarted.draw_partial(DisplayModes.GC16)
+    assert restarted.epd.calls == []
+
+@pytest.mark.parametrize('rotate', [None, 'CW'])
+def test_invalidate(rotate):
+    display = make_display(rotate=rotate)
+    display.frame_buf.paste(0x00, box=(10, 10, 50, 30))
+    display.frame_buf.paste(0x00, box=(300, 300, 340, 320))
+
+    # only the reported area is looked at, shrunk to the changes inside it
+    display.invalidate((0, 0, 100, 100))
+    display.draw_partial(DisplayModes.GC16)
+    assert display.changed_tiles is None
+    assert len(display.updates) == 1
+    xy, dims, _ = display.updates[0]
+    assert display._to_logical(xy + (xy[0]+dims[0], xy[1]+dims[1])) == (8, 8, 52, 32)
+
+    # the change that wasn't reported is found by the next full comparison
+    display.updates.clear()
+    display.draw_partial(DisplayModes.GC16)
+    assert len(display.updates) == 1
+    xy, dims, _ = display.updates[0]
+    assert display._to_logical(xy + (xy[0]+dims[0], xy[1]+dims[1])) == (300, 300, 340, 320)
+    assert display.screen.tobytes() == display.expected_screen().tobytes()
+
+    # without diffing, the reported area is updated as it is
+    display.diff_damage = False
+    display.updates.clear()
+    display.invalidate((0, 0, 100, 100))
+    w, h = display.frame_buf.size
+    display.invalidate((w-100, h-100, w+100, h+100))  # clipped to the frame
+    display.invalidate((0, 0, 0, 0))
+    display.draw_partial(DisplayModes.GC16)
+    boxes = sorted(display._to_logical(xy + (xy[0]+dims[0], xy[1]+dims[1]))
+                   for xy, dims, _ in display.updates)
+    assert boxes == [(0, 0, 100, 100), (w-100, h-100, w, h)]
@@ -1,7 +1,11 @@
+import pytest
 
-from IT8951.img_manip import make_changes_bw
+from IT8951.img_manip import make_changes_bw, diff_tiles, diff_bbox, pack_pixels, is_black_white, \
+    pack_into, set_num_threads, get_num_threads
 
-from PIL import Image
+import random
+
+from PIL import Image, ImageChops
 
 DIMS = (1200, 400)
 
@@ -20,6 +24,205 @@ def draw_gradient(img):
         )
         img.paste(color, box=box)
 
+def test_diff_tiles():
+    img1 = Image.new('L', DIMS)
+    draw_gradient(img1)
+    img2 = img1.copy()
+    img2.putpixel((40, 70), 0xFF)
+    img2.putpixel((1199, 399), 0x42)
+
+    tiles = diff_tiles(img1, img2, 32)
+    assert tiles.shape == (13, 38)
+    assert [(y, x) for y in range(13) for x in range(38) if tiles[y, x]] == [(2, 1), (12, 37)]
+
+def test_diff_bbox():
+    img1 = Image.new('L', DIMS)
+    draw_gradient(img1)
+    img2 = img1.copy()
+    assert diff_bbox(img1, img2) is None
+
+    img2.paste(0x80, box=(100, 20, 130, 25))
+    img2.putpixel((500, 300), 0x00)
+    assert diff_bbox(img1, img2) == ImageChops.difference(img1, img2).getbbox()
+    assert diff_bbox(img1, img2, (0, 0, 200, 200)) == (100, 20, 130, 25)
+    assert diff_bbox(img1, img2, (200, 0, 400, 200)) is None
+
+def test_pack_pixels_region():
+    img = Image.new('L', DIMS)
+    draw_gradient(img)
+    box = (70, 10, 110, 13)
+    region = img.crop(box).tobytes()
+
+    # the same region from a PIL image, a flat buffer with a stride, and a plain buffer
+    sources = [(img, box, None), (img.tobytes(), box, DIMS[0]), (region, None, None)]
+    for bpp in (1, 2, 4, 8):
+        expected = bytes(
+            sum((p >> (8-bpp)) << (8-bpp*(j+1)) for j, p in enumerate(region[i:i+8//bpp]))
+            for i in range(0, len(region), 8//bpp)
+        )
+        for src, src_box, stride in sources:
+            out = bytearray(len(expected))
+            assert pack_pixels(src, out, bpp, box=src_box, stride=stride) == len(region)
+            assert out == expected
+
+        # packing in pieces gives the same result
+        out = bytearray(len(expected))
+        n = pack_pixels(img, memoryview(out)[:6], bpp, box=box)
+        pack_pixels(img, memoryview(out)[6:], bpp, box=box, start=n)
+        assert out == expected
+
+def test_pack_pixels_random():
+    n = DIMS[0]*DIMS[1]
+    data = random.Random(0).getrandbits(8*n).to_bytes(n, 'little')
+    img = Image.frombytes('L', DIMS, data)
+
+    # the last box sticks out of the image, which uses the slow path
+    for box in [(0, 0, DIMS[0], 8), (8, 3, 72, 9), (1160, 390, 1208, 404)]:
+        region = img.crop(box).tobytes()
+        for bpp in (1, 2, 4, 8):
+            ppb = 8//bpp
+            expected = bytes(
+                sum((p >> (8-bpp)) << (8-bpp*(j+1)) for j, p in enumerate(region[i:i+ppb]))
+                for i in range(0, len(region), ppb)
+            )
+            out = bytearray(len(expected))
+            pack_pixels(img, out, bpp, box=box)
+            assert out == expected
+
+def test_is_black_white():
+    img = Image.new('L', DIMS, 0xFF)
+    img.paste(0x00, box=(10, 10, 20, 20))
+    img.paste(0xF3, box=(20, 10, 30, 20))
+    img.paste(0x0A, box=(30, 10, 40, 20))
+    assert is_black_white(img)
+    assert is_black_white(img.tobytes())
+
+    img.putpixel((300, 200), 0x80)
+    assert not is_black_white(img)
+    assert is_black_white(img, (0, 0, 300, 400))
+    assert not is_black_white(img.tobytes(), (290, 190, 310, 210), stride=DIMS[0])
+
+def test_diff_bpp():
+    a = Image.new('L', (100, 50), 0x80)
+    b = a.copy()
+    b.paste(0x8F, box=(10, 10, 20, 20))
+    b.paste(0xBF, box=(60, 30, 70, 40))
+
+    assert diff_bbox(a, b) == (10, 10, 70, 40)
+    assert diff_bbox(a, b, bpp=4) == (60, 30, 70, 40)
+    assert diff_bbox(a, b, bpp=2) is None
+    assert bytes(diff_tiles(a, b, 32, bpp=4)) == bytes([0, 1, 1, 0, 0, 1, 1, 0])
+    assert not any(bytes(diff_tiles(a, b, 32, bpp=2)))
+
+    with pytest.raises(ValueError):
+        diff_bbox(a, b, bpp=0)
+
+def test_pack_into():
+    img = Image.effect_noise((100, 50), 80)
+    packed = memoryview(bytearray(50*50)).cast('B', (50, 50))
+    pack_into(img, packed, 4)
+
+    expected = bytearray(100*50//2)
+    pack_pixels(img, expected, 4)
+    assert packed.tobytes() == bytes(expected)
+
+    # a region, to another position
+    pack_into(Image.new('L', (100, 50), 0x00), packed, 4, box=(10, 5, 30, 15), xy=(40, 20))
+    img.paste(0x00, box=(40, 20, 60, 30))
+    pack_pixels(img, expected, 4)
+    assert packed.tobytes() == bytes(expected)
+
+    with pytest.raises(ValueError):
+        pack_into(img, packed, 4, box=(1, 0, 11, 10))
+    with pytest.raises(ValueError):
+        pack_into(img, packed, 4, box=(0, 0, 10, 10), xy=(96, 0))
+
+def test_diff_packed():
+    a = Image.new('L', (100, 50), 0x80)
+    packed = memoryview(bytearray(50*50)).cast('B', (50, 50))
+    pack_into(a, packed, 4)
+
+    b = a.copy()
+    b.paste(0x8F, box=(10, 10, 20, 20))
+    b.paste(0xBF, box=(61, 30, 69, 40))
+    b.paste(0x40, box=(99, 49, 100, 50))
+
+    # only the top 4 bits of b are compared with the packed image
+    assert diff_bbox(packed, b, prev_bpp=4) == (61, 30, 100, 50)
+    assert diff_bbox(packed, b, box=(0, 0, 70, 45), prev_bpp=4) == (61, 30, 69, 40)
+    assert diff_bbox(packed, b, bpp=2, prev_bpp=4) == (99, 49, 100, 50)
+    assert bytes(diff_tiles(packed, b, 32, prev_bpp=4)) == bytes(diff_tiles(a, b, 32, bpp=4))
+    assert bytes(diff_tiles(packed, b, 32, bpp=2, prev_bpp=4)) == bytes([0, 0, 0, 0, 0, 0, 0, 1])
+
+    with pytest.raises(ValueError):
+        diff_bbox(a, b, prev_bpp=4)
+
+def test_make_changes_bw():
+    prev = Image.new('L', (100, 50), 0x80)
+    new = prev.copy()
+    new.paste(0xC0, box=(10, 10, 20, 20))
+    new.paste(0x00, box=(30, 10, 40, 20))
+    new.paste(0x8F, box=(50, 10, 60, 20))
+
+    # a crop of the area being updated, converted in place
+    box = (0, 5, 64, 25)
+    buf = new.crop(box)
+    assert make_changes_bw(prev, buf, box, (0, 0), bpp=4) == 100
+    expected = new.crop(box)
+    expected.paste(0xF0, box=(10, 5, 20, 15))
+    assert buf.tobytes() == expected.tobytes()
+
+    # the same against a packed prev_frame
+    packed = memoryview(bytearray(50*50)).cast('B', (50, 50))
+    pack_into(prev, packed, 4)
+    buf = new.crop(box)
+    assert make_changes_bw(packed, buf, box, (0, 0), prev_bpp=4) == 100
+    assert buf.tobytes() == expected.tobytes()
+
+    # comparing all 8 bits
+    assert make_changes_bw(prev, new) == 200
+    assert new.getpixel((55, 15)) == 0x00
+
+    with pytest.raises(ValueError):
+        make_changes_bw(prev, buf, (0, 0, 65, 20), (0, 0))
+
+@pytest.mark.parametrize('prev_bpp', [8, 4])
+def test_threads(prev_bpp):
+    # large enough to be split between threads
+    dims = (1872, 1404)
+    prev = Image.effect_noise(dims, 80)
+    new = prev.copy()
+    for x in range(0, dims[0]-100, 300):
+        new.paste(0x00, box=(x, x//2, x+60, x//2+40))
+
+    if prev_bpp == 4:
+        prev_buf = memoryview(bytearray(dims[0]*dims[1]//2)).cast('B', (dims[1], dims[0]//2))
+        pack_into(prev, prev_buf, 4)
+    else:
+        prev_buf = prev
+
+    def run():
+        work = new.copy()
+        packed = bytearray(dims[0]*dims[1]//2)
+        return (
+            bytes(diff_tiles(prev_buf, new, 32, bpp=4, prev_bpp=prev_bpp)),
+            diff_bbox(prev_buf, new, prev_bpp=prev_bpp),
+            diff_bbox(prev_buf, new, box=(700, 0, 1872, 1404), prev_bpp=prev_bpp),
+            make_changes_bw(prev_buf, work, bpp=4, prev_bpp=prev_bpp),
+            work.tobytes(),
+            pack_pixels(new, packed, 4, start=100),
+            bytes(packed),
+        )
+
+    assert get_num_threads() == 1
+    expected = run()
+    try:
+        set_num_threads(4)
+        assert get_num_threads() == 4
+        assert run() == expected
+    finally:
+        set_num_threads(1)
+
 def main():
     img1 = Image.new('L', DIMS)
     draw_gradient(img1)
@@ -0,0 +1,181 @@
+import pytest
+from PIL import Image
+
+from IT8951.interface import EPD
+from IT8951.display import AutoEPDDisplay
+from IT8951.sim import SimulatedIT8951, ProtocolError
+from IT8951.metrics import Metrics
+from IT8951.constants import DisplayModes, PixelModes, Rotate, Commands
+from IT8951 import regions
+
+from test_display import DIMS, RecordingDisplay, quantize
+
+def make_epd(**kwargs):
+    sim = SimulatedIT8951(dims=DIMS, update_times=0.02, **kwargs)
+    return EPD(vcom=-2.0, backend=sim), sim
+
+def test_device_info():
+    epd, sim = make_epd()
+    assert (epd.width, epd.height) == DIMS
+    assert epd.img_buf_address == sim.img_buf_address
+    assert epd.get_vcom() == -2.0
+
+@pytest.mark.parametrize('pixel_format, bpp', [
+    (PixelModes.M_2BPP, 2),
+    (PixelModes.M_4BPP, 4),
+    (PixelModes.M_8BPP, 8),
+])
+@pytest.mark.parametrize('rotate_mode, method', [
+    (Rotate.NONE, None),
+    (Rotate.CW, Image.Transpose.ROTATE_270),
+    (Rotate.FLIP, Image.Transpose.ROTATE_180),
+])
+def test_load_img_area(pixel_format, bpp, rotate_mode, method):
+    # a small max_block_size, so that the pixels are sent in many transfers
+    epd, sim = make_epd(max_block_size=512)
+
+    size = DIMS if method != Image.Transpose.ROTATE_270 else DIMS[::-1]
+    img = Image.effect_noise(size, 80)
+    epd.load_img_area(img.tobytes(), rotate_mode=rotate_mode, pixel_format=pixel_format)
+    expected = img if method is None else img.transpose(method)
+    assert quantize(sim.image(), bpp) == quantize(expected, bpp)
+
+    # and an area, read back from device memory
+    box = (64, 40, 192, 100)
+    epd.load_img_area(bytes(128*60), rotate_mode=rotate_mode, xy=box[:2], dims=(128, 60),
+                      pixel_format=pixel_format)
+    if method is not None:
+        box = regions.transpose_box(box, method, size)
+    expected.paste(0x00, box=box)
+    assert quantize(epd.read_img_area(), bpp) == quantize(expected, bpp)
+
+@pytest.mark.parametrize('rotate', [None, 'CW', 'flip'])
+@pytest.mark.parametrize('mirror', [False, True])
+def test_display(rotate, mirror):
+    epd, sim = make_epd()
+    display = AutoEPDDisplay(epd=epd, rotate=rotate, mirror=mirror)
+    display.frame_buf.paste(0x40, box=(0, 0, display.width, display.height//2))
+    display.draw_full(DisplayModes.GC16)
+
+    for x in range(0, 400, 80):
+        display.frame_buf.paste(0x00, box=(x+10, 10, x+50, 30))
+        display.frame_buf.paste(0x80, box=(x+10, 300, x+50, 330))
+        display.draw_partial(DisplayModes.GC16)
+    epd.wait_display_ready()
+
+    reference = RecordingDisplay(*DIMS, rotate=rotate, mirror=mirror)
+    reference.frame_buf.paste(display.frame_buf)
+    assert quantize(sim.screen, 4) == quantize(reference.expected_screen(), 4)
+
+    # the scheduler never starts an update on top of one that is running, but does
+    # run them side by side
+    assert sim.collisions == 0
+    assert sim.max_concurrent > 1
+
+def test_1bpp():
+    epd, sim = make_epd()
+    display = AutoEPDDisplay(epd=epd, use_1bpp=True)
+    display.clear()
+
+    display.frame_buf.paste(0x00, box=(70, 10, 130, 20))
+    display.draw_partial(DisplayModes.DU)
+    assert sim.displays[-1][0] == (64, 8, 160, 24)
+
+    expected = Image.new('L', DIMS, 0xFF)
+    expected.paste(0xF0, box=(64, 8, 160, 24))
+    expected.paste(0x00, box=(70, 10, 130, 20))
+    assert sim.screen.tobytes() == expected.tobytes()
+
+def test_resync():
+    epd, sim = make_epd()
+    display = AutoEPDDisplay(epd=epd, rotate='CW')
+    display.frame_buf.paste(0x80, box=(0, 0, display.width, display.height//2))
+    display.draw_full(DisplayModes.GC16)
+
+    # the controller keeps its memory through a restart of the program
+    restarted = AutoEPDDisplay(epd=EPD(vcom=-2.0, backend=sim), rotate='CW')
+    restarted.resync()
+    assert quantize(restarted.frame_buf, 4) == quantize(display.frame_buf, 4)
+
+def test_protocol_errors():
+    epd, sim = make_epd()
+    with pytest.raises(ProtocolError):
+        epd.spi.write_cmd(0x99)
+    with pytest.raises(ProtocolError):
+        epd.display_area((700, 0), (200, 100), DisplayModes.GC16)
+    sim.reset()
+    with pytest.raises(ProtocolError):
+        epd.spi.write_data([1, 2, 3])
+    sim.reset()
+
+    epd.spi.write_cmd(Commands.LD_IMG, 0)
+    with pytest.raises(ProtocolError):
+        epd.spi.write_cmd(Commands.REG_RD, 0)
+
+def test_hrdy():
+    # each word of a command waits for HRDY
+    epd, sim = make_epd(hrdy_time=0.001)
+    display = AutoEPDDisplay(epd=epd)
+    display.frame_buf.paste(0x00, box=(10, 10, 50, 30))
+    display.draw_partial(DisplayModes.GC16)
+    epd.wait_display_ready()
+    assert sim.screen.getpixel((20, 20)) == 0x00
+
+    # a command's arguments are all sent in the transaction after it
+    sizes = []
+    transfer = sim.transfer
+    def counting_transfer(data, speed_hz):
+        sizes.append(len(data))
+        return transfer(data, speed_hz)
+    sim.transfer = counting_transfer
+
+    epd.wait_display_ready()
+    sizes.clear()
+    epd.display_area((0, 0), (64, 64), DisplayModes.GC16)
+    assert sizes == [4, 2+2*5]
+
+def test_metrics():
+    records = []
+    metrics = Metrics(callback=records.append)
+    epd, sim = make_epd()
+    display = AutoEPDDisplay(epd=epd, metrics=metrics)
+    display.draw_full(DisplayModes.GC16)
+
+    sent = sim.bytes_transferred
+    display.frame_buf.paste(0x00, box=(10, 10, 50, 30))
+    display.frame_buf.paste(0x00, box=(500, 400, 540, 420))
+    display.draw_partial(DisplayModes.DU)
+    sent = sim.bytes_transferred - sent
+
+    assert [r.kind for r in records] == ['full', 'partial']
+    record = records[-1]
+    assert len(record.regions) == 2
+    assert {'diff', 'bw', 'lut_wait', 'load', 'display', 'sync'} <= set(record.stages)
+    assert sum(record.stages.values()) <= record.total
+    assert record.counters['spi_bytes'] == sent
+
+    summary = metrics.summary()
+    assert summary['total']['count'] == 2
+    assert summary['load']['p50'] <= summary['load']['p99'] <= summary['load']['max']
+    assert metrics.summary(kind='partial')['diff']['count'] == 1
+
+    # nothing is recorded without metrics, not even the SPI totals
+    display.metrics = None
+    stats = epd.spi.get_stats()
+    display.frame_buf.paste(0xFF, box=(10, 10, 50, 30))
+    display.draw_partial(DisplayModes.DU)
+    assert len(records) == 2
+    assert not epd.spi.collect_stats
+    assert epd.spi.get_stats() == stats
+
+    # a draw that fails part way doesn't leave the SPI totals being kept
+    display.metrics = metrics
+    def failing_load(*args, **kwargs):
+        raise TimeoutError
+    epd.load_img_area = failing_load
+    display.frame_buf.paste(0x00, box=(10, 10, 50, 30))
+    with pytest.raises(TimeoutError):
+        display.draw_partial(DisplayModes.DU)
+    assert not epd.spi.collect_stats
+    assert display._record is None
+    assert len(records) == 2
@@ -0,0 +1,119 @@
+from threading import Event
+
+import pytest
+
+from IT8951.worker import UpdateWorker
+from IT8951.constants import DisplayModes
+
+from test_display import make_display
+
+
+def test_worker():
+    display = make_display()
+    worker = UpdateWorker(display)
+
+    # hold up the first update until the others have been queued
+    draws = []
+    release = Event()
+    draw_partial = display.draw_partial
+    def blocking_draw_partial(mode):
+        release.wait()
+        draws.append(mode)
+        draw_partial(mode)
+    display.draw_partial = blocking_draw_partial
+
+    worker.frame_buf.paste(0x00, box=(10, 10, 50, 30))
+    first = worker.draw_partial(DisplayModes.GC16)
+    while not first.running():
+        pass
+
+    futures = []
+    for x in range(100, 400, 50):
+        worker.frame_buf.paste(0x00, box=(x, 100, x+20, 120))
+        futures.append(worker.draw_partial(DisplayModes.DU))
+    worker.frame_buf.paste(0x80, box=(500, 500, 520, 520))
+    gray = worker.draw_partial(DisplayModes.GC16)
+
+    # the snapshot was taken when the draw was requested
+    worker.frame_buf.paste(0x80, box=(600, 500, 620, 520))
+
+    release.set()
+    assert worker.flush(timeout=5)
+    assert all(f.done() and f.result() is None for f in futures + [first, gray])
+
+    # the DU draws were combined into one
+    assert draws == [DisplayModes.GC16, DisplayModes.DU, DisplayModes.GC16]
+    assert display.screen.tobytes() != worker.frame_buf.tobytes()
+
+    worker.draw_partial(DisplayModes.GC16)
+    worker.close()
+    assert display.screen.tobytes() == worker.frame_buf.tobytes()
+
+    with pytest.raises(RuntimeError):
+        worker.draw_partial(DisplayModes.GC16)
+
+def test_worker_modes():
+    # a draw only shows what had been drawn when it was requested, even when a draw
+    # in another mode is queued behind it
+    display = make_display()
+    worker = UpdateWorker(display)
+
+    release = Event()
+    draw_partial = display.draw_partial
+    def blocking_draw_partial(mode):
+        release.wait()
+        draw_partial(mode)
+    display.draw_partial = blocking_draw_partial
+
+    worker.frame_buf.paste(0x00, box=(10, 10, 50, 30))
+    first = worker.draw_partial(DisplayModes.GC16)
+    while not first.running():
+        pass
+
+    worker.frame_buf.paste(0x00, box=(100, 100, 120, 120))
+    worker.draw_partial(DisplayModes.DU)
+    worker.frame_buf.paste(0x80, box=(500, 500, 520, 520))
+    worker.draw_partial(DisplayModes.GC16)
+
+    release.set()
+    worker.close()
+    assert display.screen.getpixel((510, 510)) == 0x80
+    assert display.screen.tobytes() == worker.frame_buf.tobytes()
+
+def test_worker_error():
+    display = make_display()
+    def fail(*args):
+        raise ValueError('oops')
+    display.update = fail
+
+    with UpdateWorker(display) as worker:
+        worker.frame_buf.paste(0x00, box=(10, 10, 50, 30))
+        future = worker.draw_partial(DisplayModes.GC16)
+        with pytest.raises(ValueError):
+            future.result(timeout=5)
+
+def test_worker_invalidate():
+    display = make_display()
+    with UpdateWorker(display) as worker:
+        worker.frame_buf.paste(0x00, box=(10, 10, 50, 30))
+        worker.frame_buf.paste(0x00, box=(300, 300, 340, 320))
+        worker.invalidate((0, 0, 100, 100))
+        worker.draw_partial(DisplayModes.GC16).result(timeout=5)
+        assert display.updates == [((8, 8), (44, 24), DisplayModes.GC16)]
+
+        worker.draw_partial(DisplayModes.GC16).result(timeout=5)
+    assert display.screen.tobytes() == worker.frame_buf.tobytes()
+
+def test_worker_full_with_damage():
+    # a full draw sends all of frame_buf, even when only part of it was invalidated
+    display = make_display()
+    worker = UpdateWorker(display)
+
+    worker.clear()
+    worker.frame_buf.paste(0x00, box=(0, 0, 400, 300))
+    worker.draw_partial(DisplayModes.GC16)
+    worker.invalidate((0, 0, 10, 10))
+    worker.clear().result()
+    worker.close()
+    assert display.screen.getpixel((200, 200)) == 0xFF
+    assert display.screen.tobytes() == worker.frame_buf.tobytes()